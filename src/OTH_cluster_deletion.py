@@ -1,12 +1,41 @@
 #!/usr/bin/env python
 
 import argparse
-import re
-import subprocess
+import os
 from datetime import datetime
 from pathlib import Path
 
-from Bio import SeqIO
+import numpy as np
+
+from . import cd_hit_runner, metrics
+from .cluster_cache import ClusterCache, add_cache_arguments, cached_clusters
+from .clustering import add_backend_arguments, backend_params, cache_params, cluster
+from .fasta_index import FastaIndex
+from .fasta_io import (
+    add_compression_argument,
+    compression,
+    fasta_stem,
+    incomplete_path,
+    output_path,
+    strip_compression,
+    xopen,
+)
+
+CD_HIT_PARAMS = {"c": 0.4, "n": 2, "d": 0, "sc": 1, "sf": 1}
+# -s2 0 lets a reference sequence be shorter than the target sequences it clusters
+# with, like in a cd-hit run over both files
+CD_HIT_2D_PARAMS = {"c": 0.4, "n": 2, "d": 0, "s2": 0}
+ENGINES = ["cd-hit", "cd-hit-2d"]
+# cd-hit inputs and outputs written to the working directory as {job_id}_{name}
+INTERMEDIATE_FILES = [
+    "combined.fasta",
+    "combined_out.fasta",
+    "combined_out.fasta.clstr",
+    "2d_reference.fasta",
+    "2d_target.fasta",
+    "2d_out.fasta",
+    "2d_out.fasta.clstr",
+]
 
 
 def validate_filepath(filepath):
@@ -16,7 +45,7 @@ def validate_filepath(filepath):
     return path
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description="""
         Merge two fasta files, identify clusters of similar proteins, and delete all 
@@ -52,61 +81,80 @@ def get_args():
         "--job_id",
         type=str,
         default=None,
-        help="Optional job ID to be used in intermediate files. Default: current date and time",
+        help="Optional job ID to be used in intermediate files. "
+        "Default: current date and time",
     )
-
-    args = parser.parse_args()
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="cd-hit",
+        help="cd-hit clusters the target and reference together. cd-hit-2d only "
+        "compares the target to the reference, which is much faster for a big target, "
+        "but can't use --backend builtin. Default: cd-hit",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only compare reference sequences added since the last run against the "
+        "sequences left in the output file with cd-hit-2d, and update the outputs in "
+        "place. Can't use --backend builtin.",
+    )
+    add_backend_arguments(parser)
+    add_cache_arguments(parser)
+    cd_hit_runner.add_cd_hit_arguments(parser)
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.engine == "cd-hit-2d" and args.backend != "cd-hit":
+        parser.error("--engine cd-hit-2d needs --backend cd-hit")
+    if args.incremental and args.backend != "cd-hit":
+        # new reference sequences are compared to the output with cd-hit-2d
+        parser.error("--incremental needs --backend cd-hit")
 
     if args.output is None:
-        args.output = args.target.with_suffix(".filtered.fasta")
+        args.output = strip_compression(args.target).with_suffix(".filtered.fasta")
+    args.output = output_path(args.output, args.compress)
     if args.job_id is None:
         args.job_id = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
 
     return args
 
 
-def cd_hit(input_file, output_file, **kwargs):
-    cmd = f"""cd-hit\
-        -i {input_file}\
-        -o {output_file}\
-        -c {kwargs.get("c", 0.4)}\
-        -n {kwargs.get("n", 2)}\
-        -d 0\
-        -M 0\
-        -T 0\
-        -sc 1\
-        -sf 1
-    """
-
-    results = subprocess.run(cmd, shell=True, universal_newlines=True, check=True)
-    return results
-
+def cd_hit(
+    input_file,
+    output_file,
+    backend="cd-hit",
+    threads=0,
+    memory=0,
+    timeout=None,
+    **kwargs,
+):
+    params = {**CD_HIT_PARAMS, **kwargs}
+    return cluster(
+        input_file,
+        output_file,
+        params,
+        backend,
+        threads=threads,
+        memory=memory,
+        timeout=timeout,
+    )
 
-def digest_clusters(cluster_file_path):
-    assert (
-        cluster_file_path.is_file()
-    ), f"File not found: {cluster_file_path}. CD-hit may have not run properly"
 
-    with open(cluster_file_path) as f:
-        clusters = f.read().split(">Cluster")[1:]
-        clusters = [x for x in clusters if x.strip() != ""]
+def cd_hit_2d(
+    database_file, query_file, output_file, threads=0, memory=0, timeout=None, **kwargs
+):
+    cmd = ["cd-hit-2d", "-i", database_file, "-i2", query_file, "-o", output_file]
+    for flag, value in {**CD_HIT_2D_PARAMS, **kwargs}.items():
+        cmd += [f"-{flag}", value]
 
-    for cluster in clusters:
-        # clean up cluster
-        cluster_lines = [x.strip() for x in cluster.split("\n") if x.strip() != ""][1:]
+    cd_hit_runner.run(cmd, [database_file, query_file], threads, memory, timeout)
+    return output_file
 
-        # pull just descriptions
-        descriptions = []
-        for line in cluster_lines:
-            try:
-                descriptions.append(
-                    str(re.search("\d+aa,\s+>(.*@@@-?\d*)\.\.\.", line).group(1))
-                )
-            except AttributeError:
-                raise AttributeError(
-                    f"Could not parse line:\n{line}\nfrom cluster:\n{cluster}"
-                )
 
+def digest_clusters(clusters):
+    for descriptions in clusters:
         # skip non-mixed clusters
         source_files = [x.split("@@@")[0] for x in descriptions]
         if len(set(source_files)) == 1:
@@ -117,71 +165,248 @@ def digest_clusters(cluster_file_path):
             yield source_file, seq_hash
 
 
-def write_dict_to_fasta(d, output_file):
-    with open(output_file, "w") as f:
-        for description, seq in d.values():
-            seq_80 = re.sub("(.{64})", "\\1\n", seq, 0, re.DOTALL)
-            f.write(f">{description}\n{seq_80}\n")
+def write_filtered(
+    target_index, removed_hashes, output_file, removed_file, append=False
+):
+    # write to a temporary file first, the target can be the current output file
+    temp_output = incomplete_path(output_file)
+    with xopen(temp_output, "wb") as kept, xopen(
+        removed_file, "ab" if append else "wb"
+    ) as removed:
+        for row in range(len(target_index)):
+            handle = removed if target_index.seq_id(row) in removed_hashes else kept
+            handle.write(target_index.record(row))
+    os.replace(temp_output, output_file)
+
+
+def state_path(output_file):
+    return strip_compression(output_file).with_suffix(".state.npz")
+
+
+def save_state(output_file, reference_index):
+    with open(state_path(output_file), "wb") as f:
+        np.savez(f, reference_ids=np.unique(reference_index.ids))
+
+
+def removed_path(output_file):
+    return output_path(
+        Path(output_file).resolve().parent / f"{fasta_stem(output_file)}_removed.fasta",
+        compression(output_file),
+    )
+
+
+def incremental_update(args):
+    print("Searching new reference sequences")
+    with metrics.stage("hash", file=args.reference) as stage:
+        reference_index = FastaIndex.load_or_build(args.reference)
+        stage.records = len(reference_index)
+    with np.load(state_path(args.output)) as state:
+        new_rows = np.flatnonzero(~np.isin(reference_index.ids, state["reference_ids"]))
+    new_rows = np.intersect1d(new_rows, reference_index.unique_rows())
+
+    if len(new_rows) == 0:
+        print("No new reference sequences since the last run")
+        return
+    print(f"Comparing {len(new_rows)} new reference sequences to {args.output}")
+
+    # not saved, the output is rewritten below and an index next to it would go stale
+    with metrics.stage("hash", file=args.output) as stage:
+        surviving_index = FastaIndex.build(args.output)
+        stage.records = len(surviving_index)
+
+    removed_hashes = removed_by_cd_hit_2d(
+        args, reference_index, new_rows, surviving_index
+    )
+
+    with metrics.stage("write outputs") as stage:
+        write_filtered(
+            surviving_index,
+            removed_hashes,
+            args.output,
+            removed_path(args.output),
+            append=True,
+        )
+        stage.records = len(surviving_index)
+    surviving_index.close()
+    save_state(args.output, reference_index)
+    reference_index.close()
+
+
+def removed_by_cd_hit_2d(args, reference_index, reference_rows, target_index):
+    """
+    Hashes of the target sequences that cd-hit-2d clusters with one of
+    `reference_rows`, comparing every target sequence to the reference only.
+    """
+    reference_file = f"{args.job_id}_2d_reference.fasta"
+    target_file = f"{args.job_id}_2d_target.fasta"
+
+    with metrics.stage("write temp") as stage:
+        with open(reference_file, "wb") as f:
+            reference_index.write_renamed(
+                f,
+                lambda seq_hash: f"{fasta_stem(args.reference)}@@@{seq_hash}",
+                reference_rows,
+            )
+        target_rows = target_index.unique_rows()
+        with open(target_file, "wb") as f:
+            target_index.write_renamed(
+                f,
+                lambda seq_hash: f"{fasta_stem(args.target)}@@@{seq_hash}",
+                target_rows,
+            )
+        stage.records = len(reference_rows) + len(target_rows)
+
+    cache = None if args.no_cache else ClusterCache(args.cache_dir)
+    with metrics.stage("cluster"):
+        params = CD_HIT_2D_PARAMS
+        if cache is not None:
+            # the cache is keyed by one input file, the reference goes in the parameters
+            params = {**params, "reference": cache.key(reference_file, {})}
+        clusters, _ = cached_clusters(
+            cache,
+            target_file,
+            params,
+            lambda: cd_hit_2d(
+                reference_file,
+                target_file,
+                f"{args.job_id}_2d_out.fasta",
+                threads=args.threads,
+                memory=args.memory,
+                timeout=args.timeout,
+            ),
+        )
+
+    removed_hashes = set()
+    with metrics.stage("parse clusters") as stage:
+        for source_file, seq_hash in digest_clusters(clusters):
+            if (
+                source_file == fasta_stem(args.target)
+                and seq_hash not in removed_hashes
+            ):
+                removed_hashes.add(seq_hash)
+                row = target_index.find(seq_hash)
+                metrics.detail("\tRemoved:", target_index.header(row))
+        stage.records = len(removed_hashes)
+    print(f"Removed {len(removed_hashes)} sequences")
+
+    return removed_hashes
 
 
 def main():
     args = get_args()
+    with metrics.run("cluster_deletion", args):
+        cluster_deletion(args)
 
-    target_hash_lookup = {}
-    removed_records = {}
-    all_records = []
 
-    # combine files with hashed headers
-    print("Bundling fasta files")
-    for record in SeqIO.parse(args.target, "fasta"):
-        file_stem = args.target.stem
+def remove_intermediates(job_id):
+    for name in INTERMEDIATE_FILES:
+        Path(f"{job_id}_{name}").unlink(missing_ok=True)
+
 
-        seq_hash = str(hash(record.seq))
-        target_hash_lookup[str(seq_hash)] = (record.description, str(record.seq))
+def cluster_deletion(args):
+    try:
+        if args.incremental:
+            if state_path(args.output).is_file() and Path(args.output).is_file():
+                return incremental_update(args)
+            print(
+                f"No previous run found for {args.output}, filtering the whole target"
+            )
 
-        record.id = f"{file_stem}@@@{seq_hash}"
-        record.name = ""
-        record.description = ""
-        all_records.append(record)
+        filter_target(args)
+    finally:
+        remove_intermediates(args.job_id)
 
-    for record in SeqIO.parse(args.reference, "fasta"):
-        file_stem = args.reference.stem
 
-        seq_hash = str(hash(record.seq))
-        record.id = f"{file_stem}@@@{seq_hash}"
-        record.name = ""
-        record.description = ""
-        all_records.append(record)
+def filter_target(args):
+    print("Bundling fasta files")
+    with metrics.stage("hash") as stage:
+        target_index = FastaIndex.load_or_build(args.target)
+        reference_index = FastaIndex.load_or_build(args.reference)
+        stage.records = len(target_index) + len(reference_index)
+
+    if args.engine == "cd-hit-2d":
+        removed_hashes = removed_by_cd_hit_2d(
+            args, reference_index, reference_index.unique_rows(), target_index
+        )
+    else:
+        removed_hashes = removed_by_cd_hit(args, target_index, reference_index)
+
+    with metrics.stage("write outputs") as stage:
+        write_filtered(
+            target_index, removed_hashes, args.output, removed_path(args.output)
+        )
+        stage.records = len(target_index)
+    target_index.close()
+    save_state(args.output, reference_index)
+    reference_index.close()
+
+
+def removed_by_cd_hit(args, target_index, reference_index):
+    """
+    Hashes of the target sequences that cd-hit puts in a cluster with a reference
+    sequence, clustering both files together.
+    """
+    removed_hashes = set()
 
-    # write combined file
-    with open(f"{args.job_id}_combined.fasta", "w") as f:
-        SeqIO.write(all_records, f, "fasta")
+    # combine files with hashed headers
+    with open(f"{args.job_id}_combined.fasta", "wb") as f, metrics.stage(
+        "write temp"
+    ) as stage:
+        for fasta_index, file_stem in [
+            (target_index, fasta_stem(args.target)),
+            (reference_index, fasta_stem(args.reference)),
+        ]:
+            unique_rows = fasta_index.unique_rows()
+            print(
+                f"Collapsed {len(fasta_index) - len(unique_rows)} duplicate sequences "
+                f"in {fasta_index.fasta}"
+            )
+            fasta_index.write_renamed(
+                f, lambda seq_hash: f"{file_stem}@@@{seq_hash}", unique_rows
+            )
+            stage.add(len(unique_rows))
 
     # cluster sequences
     print("Clustering sequences")
-    results = cd_hit(
-        f"{args.job_id}_combined.fasta", f"{args.job_id}_combined_out.fasta"
-    )
+    cache = None if args.no_cache else ClusterCache(args.cache_dir)
+    params = backend_params(CD_HIT_PARAMS, args.backend, args.word_filter)
+    with metrics.stage("cluster"):
+        clusters, _ = cached_clusters(
+            cache,
+            f"{args.job_id}_combined.fasta",
+            cache_params(params, args.backend),
+            lambda: cd_hit(
+                f"{args.job_id}_combined.fasta",
+                f"{args.job_id}_combined_out.fasta",
+                backend=args.backend,
+                threads=args.threads,
+                memory=args.memory,
+                timeout=args.timeout,
+                **params,
+            ),
+        )
 
     print("Searching clusters")
-    for source_file, seq_hash in digest_clusters(
-        Path(f"{args.job_id}_combined_out.fasta.clstr")
-    ):
-        if source_file == args.target.stem:
-            if seq_hash not in target_hash_lookup:
-                raise ValueError(
-                    f"Hash from {source_file} not found in target lookup: {seq_hash}"
-                )
-
-            removed_record = target_hash_lookup.pop(seq_hash)
-            removed_records[seq_hash] = removed_record
-            print("\tRemoved:", removed_record[0])
-
-    write_dict_to_fasta(target_hash_lookup, args.output)
-    removed_file_name = (
-        Path(args.output).resolve().parent / f"{Path(args.output).stem}_removed.fasta"
-    )
-    write_dict_to_fasta(removed_records, removed_file_name)
+    with metrics.stage("parse clusters") as stage:
+        for source_file, seq_hash in digest_clusters(clusters):
+            if (
+                source_file == fasta_stem(args.target)
+                and seq_hash not in removed_hashes
+            ):
+                try:
+                    row = target_index.find(seq_hash)
+                except KeyError:
+                    raise ValueError(
+                        f"Hash from {source_file} not found in target lookup: "
+                        f"{seq_hash}"
+                    )
+
+                removed_hashes.add(seq_hash)
+                metrics.detail("\tRemoved:", target_index.header(row))
+        stage.records = len(removed_hashes)
+    print(f"Removed {len(removed_hashes)} sequences")
+
+    return removed_hashes
 
 
 if __name__ == "__main__":
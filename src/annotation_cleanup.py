@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 
 import argparse
+import io
 import re
 import sys
 from pathlib import Path
 
 import toml
-from Bio import SeqIO
+
+from . import metrics
+from .fasta_index import record_residues
+from .fasta_io import (
+    add_compression_argument,
+    compression,
+    output_path,
+    strip_compression,
+    write_record,
+    xopen,
+)
+from .parallel_scan import scan
 
 
 def validate_path(path):
@@ -16,10 +28,11 @@ def validate_path(path):
     return path
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description="""
-        Remove sequences from a FASTA file with description headers that match a list of keywords.
+        Remove sequences from a FASTA file with description headers that match a list
+        of keywords.
         """,
         formatter_class=argparse.HelpFormatter,
     )
@@ -53,12 +66,117 @@ def get_args():
     parser.add_argument(
         "-o", "--output", type=str, required=True, help="Path to the output file."
     )
-
-    return parser.parse_args()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes matching headers in chunks of the input. Default: "
+        "all cores",
+    )
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def strip_species(description):
+    # drop the last "[...]" species tag and everything after it
+    end = description.rfind("]")
+    start = description.rfind("[", 0, end)
+    if end == -1 or start == -1:
+        return description
+    return description[:start]
+
+
+class TermMatcher:
+    """
+    Class terms merged into one case-insensitive regex, so every description is
+    scanned once no matter how many terms the config has. Terms with groups of their
+    own (and so possibly backreferences to them) would change meaning in the merged
+    regex, so they are searched one by one after it.
+    """
+
+    def __init__(self, terms):
+        # (term, keys of the classes that use it)
+        self.terms = []
+        self.separate = []
+        for term, keys in terms.items():
+            try:
+                pattern = re.compile(term, re.IGNORECASE)
+            except re.error as error:
+                raise ValueError(f"Invalid term {term!r}: {error}") from None
+
+            if pattern.groups == 0 and mergeable(term):
+                self.terms.append((term, keys))
+            else:
+                self.separate.append((pattern, term, keys))
+
+        self.pattern = re.compile(
+            "|".join(f"(?P<t{i}>{term})" for i, (term, _) in enumerate(self.terms)),
+            re.IGNORECASE,
+        )
+
+    def search(self, text):
+        """Return (comma separated class keys, term) of the first match or None."""
+        if self.terms:
+            match = self.pattern.search(text)
+            if match is not None:
+                term, keys = self.terms[int(match.lastgroup[1:])]
+                return ",".join(keys), term
+
+        for pattern, term, keys in self.separate:
+            if pattern.search(text):
+                return ",".join(keys), term
+        return None
+
+
+def mergeable(term):
+    # inline flags like (?i) only compile at the start of a regex
+    try:
+        re.compile(f"(?:{term})")
+    except re.error:
+        return False
+    return True
+
+
+def filter_records(records, matcher):
+    """
+    Match the descriptions of `records` against the terms. Returns the kept and
+    discarded records as FASTA bytes, wrapped at 60 residues like SeqIO did, the
+    number kept and (id, keys, term, description) of every discarded record.
+    """
+    kept = io.BytesIO()
+    discarded = io.BytesIO()
+    kept_count = 0
+    removed = []
+
+    for _, lines in records:
+        header = lines[0][1:].rstrip()
+        residues = record_residues([line.rstrip() for line in lines[1:]])
+        description = header.decode()
+        match = matcher.search(strip_species(description))
+
+        if match is None:
+            write_record(kept, header, residues)
+            kept_count += 1
+            continue
+
+        keys, term = match
+        record_id = description.split(None, 1)[0] if description else ""
+        removed.append((record_id, keys, term, description))
+        write_record(discarded, header, residues)
+
+    return kept.getvalue(), discarded.getvalue(), kept_count, removed
 
 
 def main():
     args = get_args()
+    with metrics.run("annotation_cleanup", args):
+        cleanup(args)
+
+
+def cleanup(args):
     print(f"Parsing FASTA file: {args.fasta}")
 
     config = toml.load(args.config)
@@ -78,42 +196,49 @@ def main():
     else:
         use = args.use.split(",")
         all_keys = [x for x in config["terms"].keys() if x not in ignore and x in use]
-    terms_list = []
-
+    terms = {}
     for key in all_keys:
         for term in config["terms"][key]:
             if term not in ignore_terms:
-                terms_list.append(term)
+                terms.setdefault(term, []).append(key)
 
     print(f"Using keys: {all_keys}")
-    print(f"Using terms: {terms_list}")
+    print(f"Using terms: {list(terms)}")
+    matcher = TermMatcher(terms)
 
-    keep = []
-    discarded = []
-    with open(args.fasta, "r") as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            match = re.search("(.*)(\[.*\])", record.description)
+    output = output_path(args.output, args.compress)
+    output_stem = strip_compression(output)
+    discarded_output = output_path(
+        output_stem.with_suffix(".discarded.fasta"), compression(output)
+    )
 
-            if not match:
-                record_without_species = record.description
-            else:
-                record_without_species = match.group(1)
-
-            found = False
-            for term in terms_list:
-                if re.search(term, record_without_species, re.IGNORECASE):
-                    print(
-                        f"Removing {record.id} with description: {record.description}"
-                    )
-                    discarded.append(record)
-                    found = True
-                    break
-            if not found:
-                keep.append(record)
-
-    SeqIO.write(keep, args.output, "fasta")
-    SeqIO.write(discarded, Path(args.output).with_suffix(".discarded.fasta"), "fasta")
-    print("Sequences removed successfully.")
+    # chunks of the input are matched in parallel and written back in input order
+    kept = 0
+    discarded = 0
+    with xopen(output, "wb") as keep_handle, xopen(
+        discarded_output, "wb"
+    ) as discard_handle, open(
+        output_stem.with_suffix(".discarded.tsv"), "w"
+    ) as report, metrics.stage(
+        "filter", file=args.fasta
+    ) as stage:
+        report.write("id\tkeys\tterm\tdescription\n")
+        for kept_records, discarded_records, kept_count, removed in scan(
+            args.fasta, filter_records, matcher, jobs=args.jobs
+        ):
+            keep_handle.write(kept_records)
+            discard_handle.write(discarded_records)
+            for record_id, keys, term, description in removed:
+                metrics.detail(
+                    f"Removing {record_id} ({keys}: {term}) with description: "
+                    f"{description}"
+                )
+                report.write(f"{record_id}\t{keys}\t{term}\t{description}\n")
+            kept += kept_count
+            discarded += len(removed)
+            stage.add(kept_count + len(removed))
+
+    print(f"Removed {discarded} of {kept + discarded} sequences.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+import argparse
+import html
+import json
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import combinations
+from pathlib import Path
+
+import numpy as np
+import plotly.express as px
+
+from . import cd_hit_runner, metrics
+from .batch import fasta_files
+from .cluster_deletion_2d import validate_program
+from .cluster_reader import read_clusters
+from .fasta_index import iter_records
+from .fasta_io import strip_compression
+
+# leaks listed in the HTML report, the JSON report has all of them
+HTML_MAX_LEAKS = 1000
+
+
+def validate_path(path):
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"File not found: {path}")
+    return path
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+        Check that no sequence in one fold of a train/test split is similar to a
+        sequence in another fold, by comparing every pair of folds with cd-hit-2d.
+        Writes the number of similar sequences between every pair of folds and the
+        sequences themselves as JSON and HTML.
+        """,
+        formatter_class=argparse.HelpFormatter,
+    )
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        "-d",
+        "--fold_dir",
+        type=validate_path,
+        help="Directory with the outputs of train_test_split, {fold}_{class}.fasta. "
+        "Files with the same fold number are audited together as one fold.",
+    )
+    inputs.add_argument(
+        "-f",
+        "--fasta",
+        type=validate_path,
+        nargs="+",
+        help="FASTA files to audit, one fold each.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="leakage.json",
+        help="Path to write the leakage matrix and similar sequences to. Default: "
+        "leakage.json",
+    )
+    parser.add_argument(
+        "--html",
+        type=str,
+        default="leakage.html",
+        help="Path to write the HTML report to. Default: leakage.html",
+    )
+    parser.add_argument(
+        "-c",
+        "--identity",
+        type=float,
+        default=0.4,
+        help="Sequence identity that counts as leakage. Default: 0.4",
+    )
+    parser.add_argument(
+        "-n",
+        "--word_length",
+        type=int,
+        default=2,
+        help="cd-hit-2d word length, 2 for identities down to 0.4. Default: 2",
+    )
+    parser.add_argument(
+        "--cd-hit-2d",
+        type=validate_program,
+        required=False,
+        default="cd-hit-2d",
+        help="Path to the cd-hit-2d program.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of fold pairs to compare at once. Default: --threads",
+    )
+    cd_hit_runner.add_cd_hit_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    if args.jobs is None:
+        args.jobs = args.threads
+    args.jobs = max(1, min(args.jobs, args.threads))
+
+    return args
+
+
+def fold_name(path):
+    # {fold}_{class}.fasta from train_test_split, or the file name for anything else
+    name = strip_compression(path).name
+    prefix = name.split("_", 1)[0]
+    return prefix if prefix.isdigit() and prefix != name else name
+
+
+def fold_order(name):
+    # numbered folds first, in number order
+    return (0, int(name), "") if name.isdigit() else (1, 0, name)
+
+
+def group_folds(files):
+    """Fold name -> its files, in fold number order."""
+    folds = {}
+    for path in files:
+        folds.setdefault(fold_name(path), []).append(Path(path))
+    return {name: folds[name] for name in sorted(folds, key=fold_order)}
+
+
+def write_fold(number, files, output):
+    """
+    Write the records of a fold to one database file with short headers, which
+    cd-hit-2d keeps whole, and return the (file, record ID) of every record.
+    """
+    records = []
+    with open(output, "wb") as f:
+        for path in files:
+            for _, lines in iter_records(path):
+                header = lines[0][1:].decode().strip()
+                records.append((path.name, header.split(None, 1)[0] if header else ""))
+                f.write(f">{number}_{len(records) - 1}\n".encode())
+                f.writelines(lines[1:])
+                if not lines[-1].endswith(b"\n"):
+                    f.write(b"\n")
+    return records
+
+
+def compare_folds(
+    cd_hit_2d, database, query, output, identity, word_length, threads, memory, timeout
+):
+    """Pairs of (database row, query row) that cd-hit-2d puts in one cluster."""
+    cmd = [
+        cd_hit_2d,
+        "-i", database,
+        "-i2", query,
+        "-o", output,
+        "-c", identity,
+        "-n", word_length,
+        "-d", 0,
+        # query sequences longer than the database sequence they match count too
+        "-s2", 0,
+    ]  # fmt: skip
+    cd_hit_runner.run(
+        cmd, [database, query], threads, memory, timeout, label=Path(output).name
+    )
+
+    database_fold = Path(database).stem
+    pairs = []
+    for members in read_clusters(f"{output}.clstr"):
+        matches = [x for x in members if x.split("_")[0] == database_fold]
+        if not matches:
+            continue
+        for member in members:
+            fold, row = member.split("_")
+            if fold != database_fold:
+                pairs.append((int(matches[0].split("_")[1]), int(row)))
+    return pairs
+
+
+def audit(folds, cd_hit_2d, identity, word_length, jobs, threads, memory, timeout):
+    """
+    Compare every pair of folds with cd-hit-2d, `jobs` at a time. Every fold is
+    written to a database file once and used for all of its pairs. Returns the
+    leakage matrix, with the number of sequences of one fold similar to a sequence
+    of the other, and the similar sequences.
+    """
+    names = list(folds)
+    threads = max(1, threads // jobs)
+    memory = cd_hit_runner.memory_budget(memory, jobs)
+    matrix = np.zeros((len(names), len(names)), dtype=np.int64)
+    leaks = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        records = {}
+        with metrics.stage("write temp") as stage:
+            for i, name in enumerate(names):
+                records[i] = write_fold(i, folds[name], Path(temp_dir) / f"{i}.fasta")
+                stage.add(len(records[i]))
+
+        # the biggest pairs first, so they don't hold up the end of the run
+        sizes = {i: (Path(temp_dir) / f"{i}.fasta").stat().st_size for i in records}
+        pairs = sorted(
+            combinations(range(len(names)), 2),
+            key=lambda x: sizes[x[0]] * sizes[x[1]],
+            reverse=True,
+        )
+        print(
+            f"Comparing {len(pairs)} pairs of {len(names)} folds, {jobs} at a time with "
+            f"up to {threads} threads and {memory} MB each"
+        )
+
+        with metrics.stage("compare") as stage, ThreadPoolExecutor(jobs) as pool:
+            futures = {
+                pool.submit(
+                    compare_folds,
+                    cd_hit_2d,
+                    Path(temp_dir) / f"{i}.fasta",
+                    Path(temp_dir) / f"{j}.fasta",
+                    Path(temp_dir) / f"{i}_{j}",
+                    identity,
+                    word_length,
+                    threads,
+                    memory,
+                    timeout,
+                ): (i, j)
+                for i, j in pairs
+            }
+
+            for future in as_completed(futures):
+                i, j = futures[future]
+                similar = future.result()
+                leaked = len({row for _, row in similar})
+                matrix[i, j] = matrix[j, i] = leaked
+                print(f"Folds {names[i]} and {names[j]}: {leaked} similar sequences")
+
+                for database_row, query_row in similar:
+                    file, seq_id = records[j][query_row]
+                    similar_file, similar_id = records[i][database_row]
+                    leaks.append(
+                        {
+                            "fold": names[j],
+                            "file": file,
+                            "id": seq_id,
+                            "similar_fold": names[i],
+                            "similar_file": similar_file,
+                            "similar_id": similar_id,
+                        }
+                    )
+                stage.add()
+
+    leaks.sort(key=lambda x: (names.index(x["similar_fold"]), names.index(x["fold"])))
+    return matrix, leaks
+
+
+def write_json(path, names, folds, identity, matrix, leaks):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "identity": identity,
+                "folds": names,
+                "files": {name: [str(x) for x in folds[name]] for name in names},
+                "matrix": matrix.tolist(),
+                "leaks": leaks,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Leakage written to {Path(path).absolute()}")
+
+
+def write_html(path, names, identity, matrix, leaks):
+    fig = px.imshow(
+        matrix,
+        x=names,
+        y=names,
+        title=f"Sequences at {identity:.0%} identity or more to another fold",
+        text_auto=True,
+        color_continuous_scale="Reds",
+    ).update_layout(xaxis_title="Fold", yaxis_title="Fold", width=800, height=800)
+
+    columns = ["fold", "file", "id", "similar_fold", "similar_file", "similar_id"]
+    rows = [
+        "".join(f"<td>{html.escape(str(leak[x]))}</td>" for x in columns)
+        for leak in leaks[:HTML_MAX_LEAKS]
+    ]
+    shown = len(leaks)
+    if len(leaks) > HTML_MAX_LEAKS:
+        shown = f"first {HTML_MAX_LEAKS} of {len(leaks)}"
+
+    with open(path, "w") as output:
+        output.write('<html><head><meta charset="utf-8"><title>Fold leakage</title>')
+        output.write("</head><body>\n")
+        output.write(fig.to_html(include_plotlyjs="cdn", full_html=False))
+        output.write(f"\n<h2>Similar sequences ({shown})</h2>\n<table>\n<tr>")
+        output.write("".join(f"<th>{x}</th>" for x in columns) + "</tr>\n")
+        output.writelines(f"<tr>{row}</tr>\n" for row in rows)
+        output.write("</table>\n</body></html>\n")
+    print(f"Leakage report written to {Path(path).absolute()}")
+
+
+def main():
+    args = get_args()
+    with metrics.run("audit", args):
+        leaks = run_audit(args)
+
+    if leaks:
+        return 1
+
+
+def run_audit(args):
+    files = fasta_files(args.fold_dir) if args.fold_dir is not None else args.fasta
+    folds = group_folds(files)
+    if len(folds) < 2:
+        raise ValueError(f"Need at least two folds to audit, found {len(folds)}")
+    names = list(folds)
+    print(f"Auditing {len(names)} folds: {', '.join(names)}")
+
+    matrix, leaks = audit(
+        folds,
+        args.cd_hit_2d,
+        args.identity,
+        args.word_length,
+        args.jobs,
+        args.threads,
+        args.memory,
+        args.timeout,
+    )
+    print(f"Found {len(leaks)} pairs of similar sequences in different folds")
+
+    with metrics.stage("write outputs"):
+        write_json(args.output, names, folds, args.identity, matrix, leaks)
+        write_html(args.html, names, args.identity, matrix, leaks)
+
+    return leaks
+
+
+if __name__ == "__main__":
+    sys.exit(main())
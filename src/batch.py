@@ -0,0 +1,65 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from . import cd_hit_runner, metrics
+from .fasta_io import strip_compression
+
+FASTA_SUFFIXES = {".fasta", ".fa", ".faa", ".fas", ".fna"}
+
+
+def fasta_files(directory):
+    return sorted(
+        x
+        for x in Path(directory).iterdir()
+        if x.is_file() and strip_compression(x).suffix in FASTA_SUFFIXES
+    )
+
+
+def run_job(function, fasta, verbose, **kwargs):
+    # runs in a worker process, so its stages are sent back to the parent. Forked
+    # workers start with a copy of the parent's stages, which it already has
+    metrics.VERBOSE = verbose
+    metrics.collect()
+    function(fasta, **kwargs)
+    return metrics.collect()
+
+
+def run_batch(function, files, jobs=None, threads=0, memory=0, **kwargs):
+    """
+    Call `function(fasta, threads=..., memory=..., **kwargs)` for every file in a
+    process pool. `threads` (0 for all cores) and `memory` (MB, 0 for the available
+    memory) are split evenly between the `jobs` running at once and the biggest
+    files are started first, so the small ones fill the remaining workers instead
+    of queueing behind them.
+    """
+    files = sorted(files, key=lambda x: Path(x).stat().st_size, reverse=True)
+    if not files:
+        print("No FASTA files found")
+        return
+
+    threads = threads or os.cpu_count()
+    jobs = max(1, min(jobs or threads, threads, len(files)))
+    threads_per_job = max(1, threads // jobs)
+    memory_per_job = cd_hit_runner.memory_budget(memory, jobs)
+    print(
+        f"Processing {len(files)} files, {jobs} at a time with up to {threads_per_job} "
+        f"cd-hit threads and {memory_per_job} MB each"
+    )
+
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = {
+            pool.submit(
+                run_job,
+                function,
+                fasta,
+                metrics.VERBOSE,
+                threads=threads_per_job,
+                memory=memory_per_job,
+                **kwargs,
+            ): fasta
+            for fasta in files
+        }
+        for future in as_completed(futures):
+            metrics.STAGES.extend(future.result())
+            print(f"Done with {futures[future]}")
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from . import metrics
+from .cd_hit_stub import FAMILY_KEY_LENGTH
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+LINE_WIDTH = 60
+
+PROTEIN_NAMES = [
+    "hypothetical protein",
+    "tail fiber protein",
+    "major capsid protein",
+    "baseplate wedge subunit",
+    "portal protein",
+    "terminase large subunit",
+    "tail spike protein",
+    "DNA polymerase",
+]
+ORGANISMS = ["Escherichia phage T4", "Salmonella phage P22", "Bacillus phage SPO1"]
+CLASSES = ["CTF", "MCP", "PORT", "TSP", "OTH"]
+
+TOOLS = [
+    "cluster_deletion",
+    "train_test_split",
+    "train_test_split_lowest_cluster",
+    "train_test_split_random",
+    "annotation_cleanup",
+    "confusion_matrix",
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+        Time the tools and measure their peak memory on synthetic protein family
+        datasets, with a local stand-in for cd-hit, and save the results as JSON.
+        """,
+        formatter_class=argparse.HelpFormatter,
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=lambda x: [int(size) for size in x.split(",")],
+        default=[10_000, 100_000, 1_000_000],
+        help="Number of records in the benchmark datasets, separated by commas. "
+        "Default: 10000,100000,1000000",
+    )
+    parser.add_argument(
+        "-t",
+        "--tools",
+        type=lambda x: x.split(","),
+        default=TOOLS,
+        help=f"Tools to benchmark, separated by commas. Default: {','.join(TOOLS)}",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="benchmark.json",
+        help="Path to write the results to. Default: benchmark.json",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Results of an earlier run to compare against. Exits with an error if a "
+        "tool got slower or bigger than --tolerance allows.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="Allowed ratio of time and peak memory to the baseline. Default: 1.25",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="Directory for the datasets and tool outputs. Default: a temporary "
+        "directory that is removed afterwards",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=100, help="Random seed. Default: 100"
+    )
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    unknown = set(args.tools) - set(TOOLS)
+    if unknown:
+        parser.error(f"Unknown tools: {', '.join(sorted(unknown))}")
+
+    return args
+
+
+def generate_fasta(path, records, seed, duplicate_rate=0.02, mutation_rate=0.2):
+    """
+    Write `records` synthetic proteins in families of related sequences. Members of
+    a family share their first FAMILY_KEY_LENGTH residues, so the cd-hit stub puts
+    them in one cluster, and differ in about `mutation_rate` of the rest.
+    """
+    rng = np.random.default_rng(seed)
+    written = 0
+    family = 0
+
+    with open(path, "wb", buffering=1 << 24) as f:
+        while written < records:
+            base = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), rng.integers(60, 600))]
+            name = PROTEIN_NAMES[rng.integers(len(PROTEIN_NAMES))]
+            size = min(int(rng.geometric(0.3)), records - written)
+
+            for member in range(size):
+                if member and rng.random() < duplicate_rate:
+                    seq = previous
+                else:
+                    seq = base.copy()
+                    mutated = rng.random(len(seq)) < mutation_rate
+                    mutated[:FAMILY_KEY_LENGTH] = False
+                    seq[mutated] = AMINO_ACIDS[
+                        rng.integers(0, len(AMINO_ACIDS), mutated.sum())
+                    ]
+                    seq = seq.tobytes()
+                previous = seq
+
+                organism = ORGANISMS[rng.integers(len(ORGANISMS))]
+                f.write(f">fam{family}_{member} {name} [{organism}]\n".encode())
+                for start in range(0, len(seq), LINE_WIDTH):
+                    f.write(seq[start : start + LINE_WIDTH] + b"\n")
+
+            written += size
+            family += 1
+
+
+def generate_predictions(path, records, seed, accuracy=0.8):
+    rng = np.random.default_rng(seed)
+    true = rng.integers(0, len(CLASSES), records)
+    predicted = np.where(
+        rng.random(records) < accuracy, true, rng.integers(0, len(CLASSES), records)
+    )
+    names = np.array(CLASSES)
+
+    with open(path, "w") as f:
+        f.write("true,score,predicted\n")
+        for t, p in zip(names[true], names[predicted]):
+            f.write(f"{t},0.5,{p}\n")
+
+
+def write_cd_hit_stub(bin_dir):
+    stub = Path(bin_dir) / "cd-hit"
+    stub.write_text(f'#!/bin/sh\nexec "{sys.executable}" -m src.cd_hit_stub "$@"\n')
+    stub.chmod(0o755)
+
+
+def tool_commands(dataset, reference, predictions, work_dir):
+    config = Path(__file__).parent / "annotation_config.toml"
+    return {
+        "cluster_deletion": [
+            "src.OTH_cluster_deletion",
+            "-t", dataset,
+            "-r", reference,
+            "-o", Path(work_dir) / "filtered.fasta",
+            "-jid", "benchmark",
+            "--no_cache",
+        ],
+        "train_test_split": ["src.train_test_split", "-f", dataset, "--no_cache"],
+        "train_test_split_lowest_cluster": [
+            "src.train_test_split_lowest_cluster",
+            "-f", dataset,
+            "--no_cache",
+        ],
+        "train_test_split_random": ["src.train_test_split_random", "-f", dataset],
+        "annotation_cleanup": [
+            "src.annotation_cleanup",
+            "-f", dataset,
+            "-c", config,
+            "-o", Path(work_dir) / "cleaned.fasta",
+        ],
+        "confusion_matrix": [
+            "src.confusion_matrix",
+            "-c", predictions,
+            "-o", Path(work_dir) / "confusion_matrix.html",
+        ],
+    }  # fmt: skip
+
+
+def run_tool(module_args, work_dir, env):
+    """
+    Run a tool module and return its wall time, peak RSS, exit code and the stages it
+    reported with --metrics-json.
+    """
+    metrics_json = Path(work_dir) / f"{module_args[0]}.metrics.json"
+    cmd = [
+        sys.executable,
+        "-m",
+        *map(str, module_args),
+        "--metrics-json",
+        str(metrics_json),
+    ]
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        cmd,
+        cwd=work_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    # wait4 gives the resource usage of this child alone, unlike RUSAGE_CHILDREN
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    if process.returncode != 0:
+        print(f"\t{' '.join(cmd)} failed:\n{stderr.decode(errors='replace')[-2000:]}")
+
+    stages = []
+    if metrics_json.is_file():
+        with open(metrics_json, "r") as f:
+            stages = json.load(f)["stages"]
+
+    return {
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": round(metrics.maxrss_mb(usage), 1),
+        "returncode": process.returncode,
+        "stages": stages,
+    }
+
+
+def benchmark(sizes, tools, work_dir, seed):
+    env = dict(os.environ)
+    env["PATH"] = f"{Path(work_dir) / 'bin'}{os.pathsep}{env.get('PATH', '')}"
+    env["PYTHONPATH"] = os.pathsep.join(
+        x for x in [str(PACKAGE_ROOT), env.get("PYTHONPATH")] if x
+    )
+    (Path(work_dir) / "bin").mkdir(exist_ok=True)
+    write_cd_hit_stub(Path(work_dir) / "bin")
+
+    results = []
+    for size in sizes:
+        size_dir = Path(work_dir) / str(size)
+        size_dir.mkdir(exist_ok=True)
+        dataset = size_dir / "proteins.fasta"
+        reference = size_dir / "reference.fasta"
+        predictions = size_dir / "predictions.csv"
+
+        print(f"Generating {size} records in {size_dir}")
+        with metrics.stage("generate") as stage:
+            generate_fasta(dataset, size, seed)
+            # same seed, so the reference shares the first families with the dataset
+            generate_fasta(reference, max(1, size // 10), seed)
+            generate_predictions(predictions, size, seed)
+            stage.records = size
+
+        commands = tool_commands(dataset, reference, predictions, size_dir)
+        for tool in tools:
+            print(f"\tRunning {tool} on {size} records")
+            result = run_tool(commands[tool], size_dir, env)
+            print(f"\t\t{result['seconds']} s, {result['peak_rss_mb']} MB peak RSS")
+            results.append({"tool": tool, "records": size, **result})
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print tools that got slower or bigger than `tolerance` times the baseline."""
+    previous = {(x["tool"], x["records"]): x for x in baseline["results"]}
+    regressions = 0
+
+    for result in results:
+        old = previous.get((result["tool"], result["records"]))
+        if old is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if old[metric] and result[metric] / old[metric] > tolerance:
+                regressions += 1
+                print(
+                    f"Regression: {result['tool']} on {result['records']} records, "
+                    f"{metric} {old[metric]} -> {result[metric]}"
+                )
+
+    return regressions
+
+
+def main():
+    args = get_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir, metrics.run("benchmark", args):
+        work_dir = Path(args.work_dir or temp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        results = benchmark(args.sizes, args.tools, work_dir, args.seed)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "seed": args.seed,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {Path(args.output).absolute()}")
+
+    failed = [x for x in results if x["returncode"] != 0]
+    regressions = 0
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    if failed or regressions:
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
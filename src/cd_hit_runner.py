@@ -0,0 +1,166 @@
+import math
+import os
+import signal
+import subprocess
+import sys
+import threading
+from collections import deque
+from pathlib import Path
+
+# cd-hit's own default -M, enough for the word tables of small inputs
+BASE_MEMORY_MB = 800
+# cd-hit keeps the sequences and their word index in memory, a few times the input size
+MEMORY_PER_INPUT_MB = 10
+MEMORY_FRACTION = 0.8
+# below this much input per thread, more threads only add overhead
+INPUT_BYTES_PER_THREAD = 1 << 21
+TAIL_LINES = 20
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_mb():
+    """Memory that can be used without swapping, 0 if it can't be read."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def default_memory():
+    return int(os.environ.get("PHANNS_TOOLS_CD_HIT_MEMORY", 0))
+
+
+def default_timeout():
+    timeout = os.environ.get("PHANNS_TOOLS_CD_HIT_TIMEOUT")
+    return float(timeout) if timeout else None
+
+
+def add_cd_hit_arguments(parser, memory=True):
+    parser.add_argument(
+        "-T",
+        "--threads",
+        type=int,
+        default=available_cpus(),
+        help="Number of cores for cd-hit, shared by all the cd-hit runs started at "
+        "once. Default: all cores",
+    )
+    if memory:
+        parser.add_argument(
+            "--memory",
+            type=int,
+            default=default_memory(),
+            help="Memory budget for cd-hit in MB, given to cd-hit as -M. Default: "
+            "PHANNS_TOOLS_CD_HIT_MEMORY, or 80%% of the available memory",
+        )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=default_timeout(),
+        help="Stop cd-hit and fail after this many seconds. Default: "
+        "PHANNS_TOOLS_CD_HIT_TIMEOUT, or no limit",
+    )
+
+
+def memory_budget(memory=0, jobs=1):
+    """`memory` MB, or a share of the available memory, split between `jobs` runs."""
+    memory = memory or int(available_memory_mb() * MEMORY_FRACTION)
+    return memory // max(1, jobs)
+
+
+def tune(input_bytes, threads=0, memory=0):
+    """
+    cd-hit's -M and -T for an input of `input_bytes`: the whole `memory` budget in MB,
+    as a lower -M only makes cd-hit slower or fail, and no more threads than the input
+    can keep busy within the `threads` budget. 0 budgets mean all free memory and
+    cores. Without a budget, -M is an estimate of what the input needs.
+    """
+    busy_threads = math.ceil(input_bytes / INPUT_BYTES_PER_THREAD)
+    threads = max(1, min(threads or available_cpus(), busy_threads))
+
+    needed = BASE_MEMORY_MB + math.ceil(MEMORY_PER_INPUT_MB * input_bytes / (1 << 20))
+    budget = memory_budget(memory)
+    if budget and needed > budget:
+        print(
+            f"cd-hit may need about {needed} MB for {input_bytes} bytes of input, "
+            f"more than the {budget} MB budget"
+        )
+    return (budget or needed), threads
+
+
+def pump(stream, tail, echo, label):
+    for line in iter(stream.readline, ""):
+        tail.append(line)
+        if echo is not None:
+            echo.write(f"{label}: {line}" if label else line)
+            echo.flush()
+    stream.close()
+
+
+def run(cmd, input_files, threads=0, memory=0, timeout=None, label=None):
+    """
+    Run cd-hit or cd-hit-2d (`cmd` without -M and -T) with -M and -T tuned to the
+    size of `input_files`. Its progress output is printed as it runs, prefixed with
+    `label`, and a RuntimeError with the tail of its error output is raised if it
+    fails or runs longer than `timeout` seconds.
+    """
+    input_bytes = sum(Path(x).stat().st_size for x in input_files if Path(x).is_file())
+    memory, threads = tune(input_bytes, threads, memory)
+    cmd = [str(x) for x in cmd] + ["-M", str(memory), "-T", str(threads)]
+    name = Path(cmd[0]).name
+    print(f"Running {name} with command: {' '.join(cmd)}")
+
+    # in its own process group, so a timeout also stops anything a wrapper script started
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+        start_new_session=True,
+    )
+    stdout_tail = deque(maxlen=TAIL_LINES)
+    stderr_tail = deque(maxlen=TAIL_LINES)
+    pumps = [
+        threading.Thread(target=pump, args=(process.stdout, stdout_tail, sys.stdout, label)),
+        threading.Thread(target=pump, args=(process.stderr, stderr_tail, sys.stderr, label)),
+    ]
+    for thread in pumps:
+        thread.start()
+
+    returncode = None
+    try:
+        returncode = process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    finally:
+        # also stop cd-hit when interrupted, instead of leaving it running
+        if returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+        for thread in pumps:
+            thread.join()
+
+    if returncode == 0:
+        return
+    # cd-hit prints some of its fatal errors to stdout
+    tail = "".join(stderr_tail or stdout_tail)
+    where = f" on {label}" if label else ""
+    if returncode is None:
+        raise RuntimeError(f"{name} timed out{where} after {timeout} seconds:\n{tail}")
+    raise RuntimeError(f"{name} failed{where} with exit code {returncode}:\n{tail}")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+from .clustering import write_cd_hit_output
+from .fasta_index import iter_records, record_residues
+
+# the benchmark generator keeps this many leading residues identical within a family
+FAMILY_KEY_LENGTH = 12
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+        Deterministic stand-in for cd-hit used by the benchmarks. Clusters sequences that
+        share their first residues, which the benchmark generator keeps identical within
+        a protein family, and writes cd-hit compatible output files.
+        """,
+        formatter_class=argparse.HelpFormatter,
+    )
+    parser.add_argument("-i", dest="input_file", required=True)
+    parser.add_argument("-o", dest="output_file", required=True)
+    for flag in ["c", "n", "d", "sc", "sf", "l", "M", "T", "g", "G", "aS", "aL"]:
+        parser.add_argument(f"-{flag}", dest=flag, default=None)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    params = {
+        flag: value
+        for flag, value in vars(args).items()
+        if flag in ("d", "sc", "sf") and value is not None
+    }
+    min_length = int(args.l) if args.l is not None else 10
+
+    headers = []
+    lengths = []
+    clusters = {}
+    for i, (_, lines) in enumerate(iter_records(args.input_file)):
+        residues = record_residues([line.rstrip(b"\n") for line in lines[1:]])
+        headers.append(lines[0][1:].decode().strip())
+        lengths.append(len(residues))
+        if len(residues) <= min_length:
+            continue
+
+        members = clusters.setdefault(residues[:FAMILY_KEY_LENGTH], [])
+        members.append((i, None if not members else 0.5))
+
+    write_cd_hit_output(
+        args.input_file, args.output_file, params, headers, lengths, list(clusters.values())
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
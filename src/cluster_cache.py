@@ -0,0 +1,138 @@
+import json
+import os
+import re
+import tempfile
+from hashlib import blake2b
+from pathlib import Path
+
+from .cluster_reader import read_clusters
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "phanns-tools" / "clusters"
+DEFAULT_MAX_BYTES = 10 * 1024**3
+READ_CHUNK_SIZE = 1 << 24
+KEY_BYTES = 20
+# the cache's own entries, and those of the npz format it used before, so eviction
+# never touches other files in a --cache_dir shared with them
+ENTRY_PATTERN = re.compile(rf"[0-9a-f]{{{2 * KEY_BYTES}}}\.(clusters|npz)")
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory for cached cd-hit clusters. Default: PHANNS_TOOLS_CACHE, or "
+        "~/.cache/phanns-tools/clusters",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always run cd-hit, don't use cached clusters.",
+    )
+
+
+class ClusterCache:
+    """
+    Parsed cd-hit cluster membership keyed by a digest of the cd-hit input file and
+    the parameters that change the clustering (-c, -n, -sc, -sf, -d). Entries are
+    text files with the tab separated member IDs of one cluster per line, written
+    and read back a cluster at a time, and the least recently used ones are evicted
+    once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("PHANNS_TOOLS_CACHE", DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("PHANNS_TOOLS_CACHE_SIZE", DEFAULT_MAX_BYTES))
+
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, input_file, params):
+        digest = blake2b(digest_size=KEY_BYTES)
+        with open(input_file, "rb") as f:
+            while chunk := f.read(READ_CHUNK_SIZE):
+                digest.update(chunk)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return self.cache_dir / f"{key}.clusters"
+
+    def load(self, key):
+        # open before anything else, so an entry evicted by another process stays
+        # readable
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+        # bump the mtime so eviction sees this entry as recently used
+        os.utime(f.fileno())
+        return iter_clusters(f)
+
+    def store(self, key, clusters):
+        # a temporary file of its own, so processes storing the same key don't mix
+        with tempfile.NamedTemporaryFile(
+            dir=self.cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            try:
+                for members in clusters:
+                    f.write("\t".join(members).encode() + b"\n")
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, self.path(key))
+
+        clusters = self.load(key)
+        self.evict()
+        return clusters
+
+    def evict(self):
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            if not ENTRY_PATTERN.fullmatch(entry.name):
+                continue
+            # skip entries another process just evicted
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+
+
+def iter_clusters(f):
+    with f:
+        for line in f:
+            yield line.decode().rstrip("\n").split("\t")
+
+
+def cached_clusters(cache, input_file, params, run_cd_hit):
+    """
+    Clusters for `input_file`, read from `cache` when possible. `run_cd_hit` is only
+    called on a cache miss and must return the cd-hit output path (without the
+    .clstr suffix). Returns the clusters and that output path, which is None when
+    cd-hit was skipped.
+    """
+    if cache is None:
+        cd_hit_output = run_cd_hit()
+        return read_clusters(f"{cd_hit_output}.clstr"), cd_hit_output
+
+    key = cache.key(input_file, params)
+    clusters = cache.load(key)
+    if clusters is not None:
+        print(f"Using cached cd-hit clusters {cache.path(key)}")
+        return clusters, None
+
+    cd_hit_output = run_cd_hit()
+    return cache.store(key, read_clusters(f"{cd_hit_output}.clstr")), cd_hit_output
@@ -1,7 +1,23 @@
 import argparse
+import os
+import shutil
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from subprocess import run
+
+from . import cd_hit_runner, metrics
+from .batch import fasta_files
+from .fasta_io import (
+    add_compression_argument,
+    compression,
+    decompressed_copy,
+    strip_compression,
+    xopen,
+)
+
+COPY_BUFFER_SIZE = 1 << 24
 
 
 def validate_path(path):
@@ -12,12 +28,12 @@ def validate_path(path):
 
 
 def validate_program(program):
-    if run(["which", program]).returncode != 0:
+    if shutil.which(program) is None:
         raise FileNotFoundError(f"Program not found: {program}")
     return program
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description=r"""
         Remove sequences in each .fasta file in the target directory if the sequence
@@ -31,19 +47,189 @@ def get_args():
         "--target_dir",
         type=validate_path,
         required=True,
-        help="Path to the FASTA file to be cleaned up.",
+        help="Path to the directory of FASTA files to be cleaned up.",
+    )
+    parser.add_argument(
+        "--cd-hit-2d",
+        type=validate_program,
+        required=False,
+        default="cd-hit-2d",
+        help="Path to the cd-hit-2d program.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of cd-hit-2d runs to start at once. Default: --threads",
+    )
+    parser.add_argument(
+        "-M",
+        "--memory",
+        type=int,
+        default=cd_hit_runner.default_memory(),
+        help="Total memory in MB shared by all cd-hit-2d runs. Default: "
+        "PHANNS_TOOLS_CD_HIT_MEMORY, or 80%% of the available memory",
     )
+    parser.add_argument(
+        "--copy_db",
+        action="store_true",
+        help="Write each reference database to a temporary file instead of streaming "
+        "it to cd-hit-2d through a named pipe.",
+    )
+    cd_hit_runner.add_cd_hit_arguments(parser, memory=False)
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.jobs is None:
+        args.jobs = args.threads
+    args.jobs = max(1, min(args.jobs, args.threads))
 
-    args = parser.parse_args()
     return args
 
 
+def concatenate(fasta_files, output):
+    # like `cat`, but make sure every file ends on a new line
+    for path in fasta_files:
+        with xopen(path, "rb") as f:
+            last = b"\n"
+            while chunk := f.read(COPY_BUFFER_SIZE):
+                output.write(chunk)
+                last = chunk[-1:]
+            if last != b"\n":
+                output.write(b"\n")
+
+
+def stream_database(fifo_path, fasta_files):
+    try:
+        with open(fifo_path, "wb") as output:
+            concatenate(fasta_files, output)
+    except BrokenPipeError:
+        # cd-hit-2d exited before reading the whole database, its return code says why
+        pass
+
+
+def drain_pipe(fifo_path, writer):
+    # unblock the writer if cd-hit-2d exited without reading the whole pipe
+    fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while writer.is_alive():
+            try:
+                os.read(fd, COPY_BUFFER_SIZE)
+            except BlockingIOError:
+                pass
+            writer.join(0.1)
+    finally:
+        os.close(fd)
+
+
+def run_cd_hit_2d(
+    cd_hit_2d,
+    target,
+    database_files,
+    temp_dir,
+    threads,
+    memory,
+    copy_db,
+    compress=None,
+    timeout=None,
+):
+    output_file = f"{strip_compression(target).name}_removed_2d_40pct"
+    database = Path(temp_dir) / f"{target.name}.db.fasta"
+    query = target
+    if compression(target):
+        query = decompressed_copy(target, temp_dir)
+
+    cmd = [
+        cd_hit_2d,
+        "-c", "0.4",
+        "-n", "2",
+        "-i", str(database),
+        "-i2", str(query),
+        "-o", output_file,
+    ]  # fmt: skip
+
+    writer = None
+    if copy_db:
+        with open(database, "wb") as output, metrics.stage("write temp", file=target):
+            concatenate(database_files, output)
+    else:
+        os.mkfifo(database)
+        writer = threading.Thread(
+            target=stream_database, args=(database, database_files)
+        )
+        writer.start()
+
+    # the CPU and memory of the stage are shared with the other runs in the thread pool
+    with metrics.stage("cluster", file=target):
+        try:
+            cd_hit_runner.run(
+                cmd,
+                [*database_files, query],
+                threads,
+                memory,
+                timeout,
+                label=target.name,
+            )
+        finally:
+            if writer is not None:
+                drain_pipe(database, writer)
+            database.unlink()
+            if query != target:
+                query.unlink()
+
+    if compress is not None:
+        with open(output_file, "rb") as f, xopen(
+            f"{output_file}.{compress}", "wb"
+        ) as out:
+            shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
+        os.remove(output_file)
+        output_file = f"{output_file}.{compress}"
+    return output_file
+
+
 def main():
     args = get_args()
-    print(args)
+    with metrics.run("cluster_deletion_2d", args):
+        cluster_deletion_2d(args)
+
+
+def cluster_deletion_2d(args):
+    files = fasta_files(args.target_dir)
+    # start the biggest classes first so they don't hold up the end of the run
+    targets = sorted(files, key=lambda x: x.stat().st_size, reverse=True)
+
+    threads = max(1, args.threads // args.jobs)
+    memory = cd_hit_runner.memory_budget(args.memory, args.jobs)
+    print(
+        f"Running {len(targets)} cd-hit-2d jobs, {args.jobs} at a time with "
+        f"up to {threads} threads and {memory} MB each"
+    )
+
+    with tempfile.TemporaryDirectory() as temp_dir, ThreadPoolExecutor(
+        args.jobs
+    ) as pool:
+        jobs = {
+            pool.submit(
+                run_cd_hit_2d,
+                args.cd_hit_2d,
+                target,
+                [x for x in files if x != target],
+                temp_dir,
+                threads,
+                memory,
+                args.copy_db,
+                args.compress,
+                args.timeout,
+            ): target
+            for target in targets
+        }
+
+        for job in as_completed(jobs):
+            print(f"Done with {jobs[job].name}: {job.result()}")
 
-    script_path = Path(__file__).parent / "cluster_deletion_2d.sh"
-    run([str(script_path), args.target_dir])
+    print("All done!")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import re
+from pathlib import Path
+
+# one member line of a cd-hit .clstr file, e.g. "1\t123aa, >seq_id... at 45.00%"
+MEMBER_PATTERN = re.compile(rb"^\d+\s+(?P<length>\d+)(?:aa|nt),\s+>(?P<seq_id>.+?)\.\.\.")
+
+READ_BUFFER_SIZE = 1 << 24
+
+
+def parse_member(line):
+    match = MEMBER_PATTERN.match(line)
+    if match is None:
+        raise ValueError(f"Could not parse cd-hit cluster line: {line!r}")
+    return match.group("seq_id").decode()
+
+
+def read_clusters(cluster_file, buffer_size=READ_BUFFER_SIZE):
+    """
+    Stream a cd-hit .clstr file and yield the member sequence IDs of one cluster
+    at a time, so memory use does not depend on the size of the file.
+    """
+    cluster_file = Path(cluster_file)
+    if not cluster_file.is_file():
+        raise FileNotFoundError(
+            f"File not found: {cluster_file}. cd-hit may have not run properly"
+        )
+
+    members = None
+    with open(cluster_file, "rb", buffering=buffer_size) as f:
+        for line in f:
+            if line.startswith(b">Cluster"):
+                if members:
+                    yield members
+                members = []
+            elif members is not None and line.strip():
+                members.append(parse_member(line))
+
+    if members:
+        yield members
@@ -0,0 +1,374 @@
+import math
+
+import numpy as np
+from Bio.Align import PairwiseAligner, substitution_matrices
+
+from . import cd_hit_runner
+from .fasta_index import iter_records, record_residues
+
+AMINO_ACIDS = b"ACDEFGHIKLMNPQRSTVWY"
+ALPHABET_SIZE = len(AMINO_ACIDS) + 1
+MAX_WORD_LENGTH = 3
+# representatives aligned at most per sequence, those with the most diagonal hits
+MAX_CANDIDATES = 20
+DIAGONAL_BAND = 8
+WORD_FILTER_FRACTION = 0.625
+
+# residue -> 0..19, anything else -> 20
+RESIDUE_CODES = np.full(256, len(AMINO_ACIDS), dtype=np.int64)
+for code, residue in enumerate(AMINO_ACIDS):
+    RESIDUE_CODES[residue] = code
+    RESIDUE_CODES[residue + 32] = code
+
+
+def run_cd_hit(
+    input_file, output_file, params, program="cd-hit", threads=0, memory=0, timeout=None
+):
+    cmd = [program, "-i", input_file, "-o", output_file]
+    for flag, value in params.items():
+        cmd += [f"-{flag}", value]
+
+    cd_hit_runner.run(cmd, [input_file], threads, memory, timeout)
+    return output_file
+
+
+def encode(residues):
+    return RESIDUE_CODES[np.frombuffer(residues, dtype=np.uint8)]
+
+
+def words_of(codes, word_length):
+    """Code of the word starting at every position of `codes`."""
+    words = np.zeros(max(len(codes) - word_length + 1, 0), dtype=np.int64)
+    for i in range(word_length):
+        words = words * ALPHABET_SIZE + codes[i : len(codes) - word_length + 1 + i]
+    return words
+
+
+class WordIndex:
+    """
+    Positions of every word of the representatives, sorted by word, to find the
+    diagonals that a query shares words with each representative on.
+    """
+
+    def __init__(self):
+        self.words = np.zeros(0, dtype=np.int64)
+        self.reps = np.zeros(0, dtype=np.int64)
+        self.positions = np.zeros(0, dtype=np.int64)
+        self.max_length = 0
+
+    def add(self, rep, words):
+        order = np.argsort(words, kind="stable")
+        at = np.searchsorted(self.words, words[order], side="right")
+        self.words = np.insert(self.words, at, words[order])
+        self.reps = np.insert(self.reps, at, rep)
+        self.positions = np.insert(self.positions, at, order)
+        self.max_length = max(self.max_length, len(words))
+
+    def diagonal_hits(self, words, count, band):
+        """
+        For each of the first `count` representatives, the most words it shares with
+        the query on diagonals no more than `band` apart, so small gaps are allowed.
+        """
+        starts = np.searchsorted(self.words, words, side="left")
+        hits = np.searchsorted(self.words, words, side="right") - starts
+        total = hits.sum()
+        if total == 0:
+            return np.zeros(count, dtype=np.int64)
+
+        # every (query position, index entry) pair with the same word
+        offsets = np.repeat(starts - np.cumsum(hits) + hits, hits) + np.arange(total)
+        query_positions = np.repeat(np.arange(len(words)), hits)
+        diagonals = self.positions[offsets] - query_positions + len(words)
+
+        bands = (self.max_length + len(words)) // band + 2
+        keys, counts = np.unique(
+            self.reps[offsets] * bands + diagonals // band, return_counts=True
+        )
+        # add the next band, so hits across a band edge count together
+        following = np.searchsorted(keys, keys + 1)
+        found = following < len(keys)
+        found[found] = keys[following[found]] == keys[found] + 1
+        counts[found] += counts[following[found]]
+
+        best = np.zeros(count, dtype=np.int64)
+        np.maximum.at(best, keys // bands, counts)
+        return best
+
+
+class GreedyClusterer:
+    """
+    cd-hit style greedy incremental clustering. Sequences are processed longest
+    first; each one joins the first representative it shares at least `identity`
+    of its residues with, or becomes a new representative. Identity is counted over
+    the shorter sequence from a BLOSUM62 alignment with free end gaps.
+
+    Candidates are pruned before aligning, over all representatives at once:
+    shared residue composition and cd-hit's short word filter on shared words of
+    `word_length` bound the number of identities, and at least `word_filter` of the
+    query's words must be shared on one band of diagonals. At low identities the
+    bounds prune nothing, and the diagonal filter does the work. Only the
+    `max_candidates` representatives with the most diagonal hits are aligned, and
+    an alignment that only counts identities rules a candidate out before the
+    BLOSUM62 alignment.
+
+    Like cd-hit, sequences of `min_length` residues or fewer are thrown away.
+    """
+
+    def __init__(
+        self,
+        identity=0.9,
+        word_length=2,
+        word_filter=None,
+        max_candidates=MAX_CANDIDATES,
+        min_length=10,
+    ):
+        if not 1 <= word_length <= MAX_WORD_LENGTH:
+            raise ValueError(
+                f"The builtin clustering backend supports word lengths 1 to "
+                f"{MAX_WORD_LENGTH}, got {word_length}"
+            )
+        self.identity = identity
+        self.word_length = word_length
+        if word_filter is None:
+            word_filter = default_word_filter(identity, word_length)
+        self.word_filter = word_filter
+        self.max_candidates = max_candidates
+        self.min_length = min_length
+
+        self.aligner = PairwiseAligner(
+            mode="global",
+            substitution_matrix=substitution_matrices.load("BLOSUM62"),
+            open_gap_score=-11,
+            extend_gap_score=-1,
+        )
+        self.aligner.end_gap_score = 0
+        self.alphabet = set(self.aligner.substitution_matrix.alphabet)
+        # the most identities any alignment can have, from a score-only alignment
+        self.identity_bound = PairwiseAligner(
+            mode="global", match_score=1, mismatch_score=0, gap_score=0
+        )
+
+    def aligned_identities(self, representative, query, needed):
+        if self.identity_bound.score(representative, query) < needed:
+            return 0
+        return self.aligner.align(representative, query)[0].counts().identities
+
+    def cluster(self, sequences):
+        """
+        Cluster a list of residue byte strings. Returns, for every sequence, the
+        index of its representative and its identity to it, or None for sequences
+        that were thrown away.
+        """
+        sequences = [
+            "".join(x if x in self.alphabet else "X" for x in seq.decode().upper())
+            for seq in sequences
+        ]
+        order = sorted(
+            (i for i, seq in enumerate(sequences) if len(seq) > self.min_length),
+            key=lambda i: -len(sequences[i]),
+        )
+
+        representatives = []
+        rep_composition = np.zeros((16, ALPHABET_SIZE), dtype=np.int32)
+        rep_words = np.zeros((16, ALPHABET_SIZE**self.word_length), dtype=np.int32)
+        index = WordIndex()
+        assignments = [None] * len(sequences)
+
+        for i in order:
+            codes = encode(sequences[i].encode())
+            length = len(codes)
+            composition = np.bincount(codes, minlength=ALPHABET_SIZE)
+            words = words_of(codes, self.word_length)
+            counts = np.bincount(words, minlength=ALPHABET_SIZE**self.word_length)
+
+            needed = math.ceil(self.identity * length)
+            count = len(representatives)
+            passed = (
+                np.minimum(rep_composition[:count], composition).sum(axis=1) >= needed
+            )
+
+            words_needed = len(words) - self.word_length * (length - needed)
+            if words_needed > 0:
+                shared = np.minimum(rep_words[:count], counts).sum(axis=1)
+                passed &= shared >= words_needed
+
+            hits = index.diagonal_hits(words, count, DIAGONAL_BAND)
+            passed &= hits >= math.ceil(self.word_filter * len(words))
+            candidates = np.flatnonzero(passed)
+            if len(candidates) > self.max_candidates:
+                best = np.argsort(-hits[candidates], kind="stable")
+                candidates = np.sort(candidates[best[: self.max_candidates]])
+
+            for candidate in candidates:
+                rep = representatives[candidate]
+                identities = self.aligned_identities(
+                    sequences[rep], sequences[i], needed
+                )
+                if identities >= needed:
+                    assignments[i] = (rep, identities / length)
+                    break
+            else:
+                if count == len(rep_words):
+                    size = 2 * len(rep_words)
+                    rep_composition = np.resize(rep_composition, (size, ALPHABET_SIZE))
+                    rep_words = np.resize(rep_words, (size, rep_words.shape[1]))
+                rep_composition[count] = composition
+                rep_words[count] = counts
+                index.add(count, words)
+                assignments[i] = (i, 1.0)
+                representatives.append(i)
+
+        return assignments
+
+
+def default_word_filter(identity, word_length):
+    # a word survives in an alignment at `identity` with about identity**word_length
+    # odds; 0.625 of that keeps the diverged members of a cluster, indels included
+    return WORD_FILTER_FRACTION * identity**word_length
+
+
+def description_id(header, description_length):
+    # what cd-hit prints for -d: the ID up to the first space for 0, else a prefix
+    if description_length == 0:
+        return header.split()[0]
+    return header[:description_length]
+
+
+def run_builtin(input_file, output_file, params, program=None, threads=0, **kwargs):
+    """
+    Cluster `input_file` with GreedyClusterer using cd-hit's -c, -n, -d, -sc and -sf
+    parameters, and write cd-hit compatible `output_file` and `output_file.clstr`.
+    """
+    print(f"Clustering {input_file} with the builtin backend")
+    headers = []
+    sequences = []
+    for _, lines in iter_records(input_file):
+        headers.append(lines[0][1:].decode().strip())
+        sequences.append(record_residues([line.rstrip(b"\n") for line in lines[1:]]))
+
+    word_filter = params.get("word_filter")
+    if word_filter is not None:
+        word_filter = float(word_filter)
+    clusterer = GreedyClusterer(
+        identity=float(params.get("c", 0.9)),
+        word_length=int(params.get("n", 2)),
+        word_filter=word_filter,
+        min_length=int(params.get("l", 10)),
+    )
+    assignments = clusterer.cluster(sequences)
+
+    clusters = {}
+    for i, assignment in enumerate(assignments):
+        if assignment is None:
+            continue
+        rep, identity = assignment
+        clusters.setdefault(rep, []).append((i, None if rep == i else identity))
+    clusters = list(clusters.values())
+    for members in clusters:
+        # representative first, like cd-hit
+        members.sort(key=lambda member: member[1] is not None)
+
+    write_cd_hit_output(
+        input_file, output_file, params, headers, list(map(len, sequences)), clusters
+    )
+    return output_file
+
+
+def write_cd_hit_output(input_file, output_file, params, headers, lengths, clusters):
+    """
+    Write clusters the way cd-hit does: `output_file` with the representative records
+    and `output_file.clstr`. `clusters` lists the (record number, identity) pairs of
+    every cluster with the representative first and its identity None. cd-hit's -d,
+    -sc and -sf in `params` are followed.
+    """
+    if int(params.get("sc", 0)):
+        clusters = sorted(clusters, key=len, reverse=True)
+
+    description_length = int(params.get("d", 20))
+    with open(f"{output_file}.clstr", "w") as f:
+        for cluster_number, members in enumerate(clusters):
+            f.write(f">Cluster {cluster_number}\n")
+            for j, (i, identity) in enumerate(members):
+                name = description_id(headers[i], description_length)
+                match = "*" if identity is None else f"at {100 * identity:.2f}%"
+                f.write(f"{j}\t{lengths[i]}aa, >{name}... {match}\n")
+
+    # representatives in cluster order for -sf 1, otherwise in file order
+    representatives = [members[0][0] for members in clusters]
+    if not int(params.get("sf", 0)):
+        representatives.sort()
+    position = {rep: i for i, rep in enumerate(representatives)}
+    records = [None] * len(representatives)
+    for i, (_, lines) in enumerate(iter_records(input_file)):
+        if i in position:
+            records[position[i]] = lines
+
+    with open(output_file, "wb") as f:
+        for lines in records:
+            f.writelines(lines)
+            if not lines[-1].endswith(b"\n"):
+                f.write(b"\n")
+
+
+BACKENDS = {"cd-hit": run_cd_hit, "builtin": run_builtin}
+
+
+def add_backend_arguments(parser):
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="cd-hit",
+        help="Clustering backend: the cd-hit program, or the slower builtin greedy "
+        "clustering for machines without cd-hit. Default: cd-hit",
+    )
+    parser.add_argument(
+        "--word_filter",
+        type=float,
+        default=None,
+        help="Builtin backend only: the fraction of a sequence's words it must share "
+        "with a representative on one band of diagonals to be aligned to it. Higher "
+        "is faster but can miss diverged members. Default: 0.625 x identity^word "
+        "length, 0.1 for -c 0.4 -n 2",
+    )
+
+
+def backend_params(params, backend, word_filter=None):
+    # the word filter only tunes the builtin backend, and is part of its cache key
+    if backend == "builtin" and word_filter is not None:
+        return {**params, "word_filter": word_filter}
+    return params
+
+
+def cluster(
+    input_file,
+    output_file,
+    params,
+    backend="cd-hit",
+    program="cd-hit",
+    threads=0,
+    memory=0,
+    timeout=None,
+):
+    """
+    Cluster `input_file` with one of BACKENDS. Every backend writes `output_file`
+    and cd-hit's `output_file.clstr` and returns `output_file`. `threads` and
+    `memory` are budgets for cd-hit, see cd_hit_runner.tune.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown clustering backend: {backend}")
+    return BACKENDS[backend](
+        input_file,
+        output_file,
+        params,
+        program=program,
+        threads=threads,
+        memory=memory,
+        timeout=timeout,
+    )
+
+
+def cache_params(params, backend):
+    # cd-hit keeps the plain parameters so clusters cached before backends existed still hit
+    if backend == "cd-hit":
+        return params
+    return {**params, "backend": backend}
@@ -1,11 +1,16 @@
 import argparse
+import json
 import sys
+from itertools import islice
 from pathlib import Path
 
 import numpy as np
 import plotly.express as px
 from plotly.io import to_html
 
+from . import metrics
+from .fasta_io import xopen
+
 
 def validate_path(path):
     path = Path(path)
@@ -25,8 +30,11 @@ def get_args():
         "-c",
         "--csv_path",
         type=validate_path,
+        nargs="+",
         required=True,
-        help="Path to write the confusion matrix graph.",
+        help="Prediction CSV files with the true class in the first column and the "
+        "predicted class in the last, optionally gzip or zstd compressed. Counts from "
+        "all files are combined.",
     )
     parser.add_argument(
         "-o",
@@ -36,26 +44,70 @@ def get_args():
         default="confusion_matrix.html",
         help="Path to write the confusion matrix graph.",
     )
+    parser.add_argument(
+        "--counts_path",
+        type=str,
+        required=False,
+        default=None,
+        help="Optional .json or .npz file to write the combined and per-file counts "
+        "to.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1_000_000,
+        help="Number of CSV lines to read at a time. Default: 1000000",
+    )
+    metrics.add_metrics_arguments(parser)
 
     args = parser.parse_args()
     return args
 
 
-def confusion_matrix(file_path, true_class, predicted_class):
-    all_classes = list(set(true_class).union(set(predicted_class)))
-    classes = {x: i for i, x in enumerate(sorted(all_classes))}
+def encode_column(column, lookup):
+    # unseen labels get the next free code
+    return np.fromiter(
+        (lookup.setdefault(x, len(lookup)) for x in column),
+        dtype=np.int64,
+        count=len(column),
+    )
+
 
-    matrix = np.zeros((len(classes), len(classes)))
-    for true, pred in zip(true_class, predicted_class):
-        matrix[classes[true]][classes[pred]] += 1
+def sorted_codes(lookup):
+    """Sorted labels and, for each of them, the code `lookup` gave it."""
+    labels = sorted(lookup)
+    return labels, np.array([lookup[x] for x in labels], dtype=np.int64)
 
-    row_sums = matrix.sum(axis=1)
-    normalized_matrix = matrix / row_sums[:, np.newaxis]
+
+def class_statistics(matrix):
+    correct = np.diag(matrix).astype(np.float64)
+    support = matrix.sum(axis=1)
+    predicted = matrix.sum(axis=0)
+
+    precision = np.divide(
+        correct, predicted, out=np.zeros_like(correct), where=predicted > 0
+    )
+    recall = np.divide(correct, support, out=np.zeros_like(correct), where=support > 0)
+    f1_denominator = precision + recall
+    f1 = np.divide(
+        2 * precision * recall,
+        f1_denominator,
+        out=np.zeros_like(correct),
+        where=f1_denominator > 0,
+    )
+    return {"precision": precision, "recall": recall, "f1": f1, "support": support}
+
+
+def plot_confusion_matrix(file_path, labels, matrix):
+    row_sums = matrix.sum(axis=1, keepdims=True)
+    normalized_matrix = np.divide(
+        matrix, row_sums, out=np.zeros(matrix.shape), where=row_sums > 0
+    )
 
     fig = px.imshow(
         normalized_matrix,
-        x=list(classes.keys()),
-        y=list(classes.keys()),
+        x=list(labels),
+        y=list(labels),
         title="Confusion Matrix - Recall",
         text_auto=".2f",
     ).update_layout(
@@ -70,27 +122,119 @@ def confusion_matrix(file_path, true_class, predicted_class):
     print(f"Confusion matrix graph written to {Path(file_path).absolute()}")
 
 
-def print_statistics(true_class, predicted_class):
-    all_classes = list(set(true_class).union(set(predicted_class)))
-    correct = [true if true == pred else False for true, pred in zip(true_class, predicted_class)]
+def print_statistics(labels, matrix):
+    statistics = class_statistics(matrix)
 
-    for cls in all_classes:
-        cls_support = sum([1 for x in true_class if x == cls])
-        cls_correct = sum([1 for x in correct if x == cls])
-        print(f"    Class: {cls} - Support: {cls_support} - Accuracy: {(cls_correct / cls_support):.4f}")
+    for i, cls in enumerate(labels):
+        print(
+            f"    Class: {cls} - Support: {statistics['support'][i]}"
+            f" - Precision: {statistics['precision'][i]:.4f}"
+            f" - Recall: {statistics['recall'][i]:.4f}"
+            f" - F1: {statistics['f1'][i]:.4f}"
+        )
 
-    accuracy = len([x for x in correct if x]) / len(correct)
+    total = matrix.sum()
+    accuracy = np.trace(matrix) / total if total else 0.0
     print(f"Overall Accuracy: {accuracy:.4f}")
 
 
+class CountAccumulator:
+    """
+    Confusion counts added up chunk by chunk for several named sources (e.g. one
+    per fold), so memory depends on the number of classes only.
+    """
+
+    def __init__(self):
+        self.lookup = {}
+        self.matrices = {}
+
+    def add(self, name, true_class, predicted_class):
+        true_codes = encode_column(true_class, self.lookup)
+        predicted_codes = encode_column(predicted_class, self.lookup)
+        size = len(self.lookup)
+
+        counts = np.bincount(
+            true_codes * size + predicted_codes, minlength=size**2
+        ).reshape(size, size)
+
+        matrix = self.matrices.get(name, np.zeros((0, 0), dtype=np.int64))
+        old_size = len(matrix)
+        counts[:old_size, :old_size] += matrix
+        self.matrices[name] = counts
+
+    def result(self):
+        """Sorted labels, the combined matrix and a matrix per source."""
+        labels, order = sorted_codes(self.lookup)
+        size = len(labels)
+
+        matrices = {}
+        for name, matrix in self.matrices.items():
+            padded = np.zeros((size, size), dtype=np.int64)
+            padded[: len(matrix), : len(matrix)] = matrix
+            matrices[name] = padded[np.ix_(order, order)]
+
+        combined = sum(matrices.values(), np.zeros((size, size), dtype=np.int64))
+        return labels, combined, matrices
+
+
+def read_chunks(csv_path, chunk_size):
+    with xopen(csv_path, "r") as f:
+        next(f, None)
+        while lines := list(islice(f, chunk_size)):
+            yield (
+                [line.split(",")[0].strip() for line in lines],
+                [line.split(",")[-1].strip() for line in lines],
+            )
+
+
+def write_counts(file_path, labels, combined, matrices):
+    if str(file_path).endswith(".npz"):
+        np.savez(
+            file_path,
+            labels=np.array(labels),
+            combined=combined,
+            files=np.array(list(matrices)),
+            per_file=np.array(list(matrices.values())).reshape(-1, *combined.shape),
+        )
+    else:
+        with open(file_path, "w") as f:
+            json.dump(
+                {
+                    "labels": labels,
+                    "combined": combined.tolist(),
+                    "files": {name: x.tolist() for name, x in matrices.items()},
+                },
+                f,
+            )
+    print(f"Confusion counts written to {Path(file_path).absolute()}")
+
+
 def main():
     args = get_args()
-    with open(args.csv_path, "r") as f:
-        lines = f.readlines()[1:]
-        true_class = [line.split(",")[0].strip() for line in lines]
-        predicted_class = [line.split(",")[-1].strip() for line in lines]
-    confusion_matrix(args.output_path, true_class, predicted_class)
-    print_statistics(true_class, predicted_class)
+    with metrics.run("confusion_matrix", args):
+        report(args)
+
+
+def report(args):
+    counts = CountAccumulator()
+    for csv_path in args.csv_path:
+        with metrics.stage("parse", file=csv_path) as stage:
+            for true_class, predicted_class in read_chunks(csv_path, args.chunk_size):
+                counts.add(str(csv_path), true_class, predicted_class)
+                stage.add(len(true_class))
+    labels, matrix, file_matrices = counts.result()
+
+    with metrics.stage("write outputs"):
+        plot_confusion_matrix(args.output_path, labels, matrix)
+        if args.counts_path is not None:
+            write_counts(args.counts_path, labels, matrix, file_matrices)
+
+    if len(file_matrices) > 1:
+        for name, file_matrix in file_matrices.items():
+            total = file_matrix.sum()
+            accuracy = np.trace(file_matrix) / total if total else 0.0
+            print(f"{name} - Accuracy: {accuracy:.4f}")
+    print_statistics(labels, matrix)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .fasta_io import compression, decompressed_copy, xopen
+from .sequence_ids import ID_BYTES, SequenceIdRegistry
+
+INDEX_SUFFIX = ".idx.npz"
+
+
+def default_index_path(fasta):
+    # indexes of symlinked files live next to the file they point to
+    fasta = Path(fasta).resolve()
+    return fasta.with_name(fasta.name + INDEX_SUFFIX)
+
+
+def record_residues(seq_lines):
+    return b"".join(seq_lines).replace(b" ", b"").replace(b"\r", b"")
+
+
+def iter_records(fasta):
+    """
+    Yield (offset, lines) for every record in a FASTA file, where lines are the raw
+    lines of the record, header included, and offset is where the record starts in
+    the decompressed file.
+    """
+    offset = 0
+    start = None
+    lines = []
+
+    with xopen(fasta, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if start is not None:
+                    yield start, lines
+                start = offset
+                lines = []
+            if start is not None:
+                lines.append(line)
+            offset += len(line)
+
+    if start is not None:
+        yield start, lines
+
+
+def scan_fasta(fasta):
+    """
+    Yield (offset, length, residues) for every record in a FASTA file, where
+    offset and length are the byte range of the record in the file.
+    """
+    for offset, lines in iter_records(fasta):
+        yield offset, sum(map(len, lines)), record_residues(
+            [line.rstrip(b"\n") for line in lines[1:]]
+        )
+
+
+class FastaIndex:
+    """
+    Sequence ID -> byte range and residue count of each record in a FASTA file,
+    kept in numpy arrays so memory scales with the number of records and not their
+    length.
+    Records are read back by slicing a read-only mmap of the source file, or of a
+    temporary decompressed copy of it for .gz and .zst files.
+    """
+
+    def __init__(self, fasta, ids, offsets, lengths, residues):
+        self.fasta = Path(fasta)
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = lengths
+        self.residues = residues
+
+        self._order = np.argsort(ids, kind="stable")
+        self._sorted_ids = ids[self._order]
+        self._file = None
+        self._mmap = None
+        self._decompressed = None
+
+    @classmethod
+    def build(cls, fasta):
+        sequence_ids = SequenceIdRegistry()
+        ids, offsets, lengths, residue_counts = [], [], [], []
+
+        for offset, length, residues in scan_fasta(fasta):
+            ids.append(sequence_ids.assign(residues))
+            offsets.append(offset)
+            lengths.append(length)
+            residue_counts.append(len(residues))
+
+        return cls(
+            fasta,
+            np.array(ids, dtype=f"S{2 * ID_BYTES}"),
+            np.array(offsets, dtype=np.uint64),
+            np.array(lengths, dtype=np.uint64),
+            np.array(residue_counts, dtype=np.uint32),
+        )
+
+    @classmethod
+    def load_or_build(cls, fasta, index_path=None):
+        fasta = Path(fasta)
+        index_path = Path(index_path) if index_path else default_index_path(fasta)
+        stat = fasta.stat()
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if index_path.is_file():
+            with np.load(index_path) as saved:
+                if "residues" in saved and np.array_equal(saved["source"], source):
+                    return cls(
+                        fasta,
+                        saved["ids"],
+                        saved["offsets"],
+                        saved["lengths"],
+                        saved["residues"],
+                    )
+
+        print(f"Indexing {fasta}")
+        index = cls.build(fasta)
+        try:
+            with open(index_path, "wb") as f:
+                np.savez(
+                    f,
+                    source=source,
+                    ids=index.ids,
+                    offsets=index.offsets,
+                    lengths=index.lengths,
+                    residues=index.residues,
+                )
+        except OSError as e:
+            print(f"Could not save FASTA index to {index_path}: {e}")
+
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._mmap = None
+        self._file = None
+        if self._decompressed is not None:
+            self._decompressed.unlink()
+        self._decompressed = None
+
+    def _buffer(self):
+        if self._mmap is None:
+            source = self.fasta
+            if compression(self.fasta):
+                self._decompressed = decompressed_copy(self.fasta)
+                source = self._decompressed
+            self._file = open(source, "rb")
+            if os.fstat(self._file.fileno()).st_size == 0:
+                self._mmap = b""
+            else:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def seq_id(self, row):
+        return self.ids[row].decode()
+
+    def find(self, seq_id):
+        """Row of the first record in the file with this sequence ID."""
+        key = seq_id.encode() if isinstance(seq_id, str) else seq_id
+        i = np.searchsorted(self._sorted_ids, key)
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != key:
+            raise KeyError(seq_id)
+        return int(self._order[i])
+
+    def find_all(self, seq_id):
+        """Rows of every record in the file with this sequence ID, in file order."""
+        key = seq_id.encode() if isinstance(seq_id, str) else seq_id
+        start = np.searchsorted(self._sorted_ids, key, side="left")
+        end = np.searchsorted(self._sorted_ids, key, side="right")
+        if start == end:
+            raise KeyError(seq_id)
+        return self._order[start:end]
+
+    def unique_rows(self):
+        """
+        Row of the first record of every distinct sequence, in file order. Exact
+        duplicates share a sequence ID and can be found again with `find_all`.
+        """
+        if len(self) == 0:
+            return self._order
+        first = np.concatenate([[True], self._sorted_ids[1:] != self._sorted_ids[:-1]])
+        return np.sort(self._order[first])
+
+    def record(self, row):
+        """Raw bytes of a record, header line included."""
+        start = int(self.offsets[row])
+        record = self._buffer()[start : start + int(self.lengths[row])]
+        if not record.endswith(b"\n"):
+            record += b"\n"
+        return record
+
+    def header(self, row):
+        record = self.record(row)
+        return record[1 : record.index(b"\n")].rstrip(b"\r").decode()
+
+    def sequence(self, row):
+        record = self.record(row)
+        return record_residues(record[record.index(b"\n") + 1 :].split(b"\n")).decode()
+
+    def write_records(self, rows, handle):
+        for row in rows:
+            handle.write(self.record(row))
+
+    def write_renamed(self, handle, rename, rows=None):
+        """Write records (all by default) with the header replaced by `rename(seq_id)`."""
+        for row in range(len(self)) if rows is None else rows:
+            record = self.record(row)
+            body = record[record.index(b"\n") + 1 :]
+            handle.write(f">{rename(self.seq_id(row))}\n".encode() + body)
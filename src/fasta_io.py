@@ -0,0 +1,213 @@
+import gzip
+import io
+import queue
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+BUFFER_SIZE = 1 << 24
+CHUNK_SIZE = 1 << 22
+QUEUE_CHUNKS = 4
+LINE_WIDTH = 60
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+COMPRESSION_SUFFIXES = {".gz": "gz", ".zst": "zst"}
+COMPRESSIONS = tuple(COMPRESSION_SUFFIXES.values())
+
+
+def compression(path):
+    return COMPRESSION_SUFFIXES.get(Path(path).suffix)
+
+
+def strip_compression(path):
+    path = Path(path)
+    return path.with_suffix("") if compression(path) else path
+
+
+def fasta_stem(path):
+    """Stem of a FASTA file name, ignoring a compression suffix: x.fasta.gz -> x"""
+    return strip_compression(path).stem
+
+
+def output_path(path, compress=None):
+    """`path` with the suffix of `compress` added, unless it already has one."""
+    path = Path(path)
+    if compress is None or compression(path):
+        return path
+    return path.with_name(f"{path.name}.{compress}")
+
+
+def add_compression_argument(parser):
+    parser.add_argument(
+        "-z",
+        "--compress",
+        choices=COMPRESSIONS,
+        default=None,
+        help="Compress the output files with gzip or zstd (zstd needs the zstandard "
+        "package). Compressed inputs (.gz, .zst) are always read transparently.",
+    )
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "Reading or writing .zst files needs the zstandard package: "
+            "pip install zstandard"
+        ) from None
+    return zstandard
+
+
+def _open_raw(path, mode):
+    kind = compression(path)
+    if kind == "gz":
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    if kind == "zst":
+        zstandard = _zstandard()
+        if "r" in mode:
+            return zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"), closefd=True
+            )
+        # every append starts a new zstd frame, which readers handle like gzip members
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            open(path, mode), closefd=True
+        )
+    return open(path, mode, buffering=BUFFER_SIZE)
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Decompress a file in a background thread, a chunk ahead of the reader. zlib and
+    zstd release the GIL, so decompression overlaps with parsing.
+    """
+
+    def __init__(self, path):
+        self._chunks = queue.Queue(QUEUE_CHUNKS)
+        self._buffer = b""
+        self._error = None
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._read, args=(path,), daemon=True)
+        self._thread.start()
+
+    def _read(self, path):
+        try:
+            with _open_raw(path, "rb") as f:
+                while not self._closing.is_set():
+                    chunk = f.read(CHUNK_SIZE)
+                    self._chunks.put(chunk)
+                    if not chunk:
+                        break
+        except Exception as e:
+            self._error = e
+            self._chunks.put(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._buffer:
+            self._buffer = self._chunks.get()
+            if not self._buffer:
+                if self._error is not None:
+                    raise self._error
+                self._chunks.put(b"")
+                return 0
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._closing.set()
+            # unblock the reader thread if it's waiting on a full queue
+            while self._thread.is_alive():
+                try:
+                    self._chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        super().close()
+
+
+class ThreadedWriter(io.RawIOBase):
+    """Compress and write a file in a background thread while the caller keeps writing."""
+
+    def __init__(self, path, mode):
+        self._chunks = queue.Queue(QUEUE_CHUNKS)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, args=(path, mode), daemon=True)
+        self._thread.start()
+
+    def _write(self, path, mode):
+        try:
+            with _open_raw(path, mode) as f:
+                while (chunk := self._chunks.get()) is not None:
+                    f.write(chunk)
+        except Exception as e:
+            self._error = e
+            # keep draining so the writer never blocks on a full queue
+            while self._chunks.get() is not None:
+                pass
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._chunks.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._chunks.put(None)
+            self._thread.join()
+        super().close()
+        if self._error is not None:
+            raise self._error
+
+
+def xopen(path, mode="rb"):
+    """
+    Open a file for reading ("rb", "r") or writing ("wb", "ab", "w", "a") with a large
+    buffer, compressing or decompressing .gz and .zst files in a background thread.
+    """
+    binary = mode.replace("t", "").rstrip("b")
+    if compression(path) is None:
+        handle = open(path, binary + "b", buffering=BUFFER_SIZE)
+    elif binary == "r":
+        handle = io.BufferedReader(ThreadedReader(path), BUFFER_SIZE)
+    else:
+        handle = io.BufferedWriter(ThreadedWriter(path, binary + "b"), BUFFER_SIZE)
+
+    if "b" in mode:
+        return handle
+    return io.TextIOWrapper(handle)
+
+
+def write_record(handle, header, residues, width=LINE_WIDTH):
+    """Write a FASTA record to a binary handle, wrapping the sequence every `width` residues."""
+    handle.write(b">" + header + b"\n")
+    for start in range(0, len(residues), width):
+        handle.write(residues[start : start + width] + b"\n")
+
+
+def decompressed_copy(path, directory=None):
+    """Decompress `path` to a temporary file for random access and return its path."""
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=directory, suffix=strip_compression(path).suffix, delete=False
+    ) as temp_file, xopen(path, "rb") as f:
+        shutil.copyfileobj(f, temp_file, CHUNK_SIZE)
+    return Path(temp_file.name)
+
+
+def incomplete_path(path):
+    """Where to write `path` before renaming it into place, keeping its compression."""
+    path = Path(path)
+    if compression(path):
+        return path.with_name(f"{path.stem}.incomplete{path.suffix}")
+    return path.with_name(f"{path.name}.incomplete")
@@ -0,0 +1,87 @@
+import heapq
+from itertools import chain
+
+import numpy as np
+
+STRATEGIES = ("snake", "lowest", "lpt")
+WEIGHTS = ("sequences", "residues")
+
+
+def cluster_weights(cluster_rows, residues=None):
+    """
+    Size of every cluster, counted in sequences or, when `residues` (residue count
+    per row) is given, in residues.
+    """
+    sizes = np.fromiter(map(len, cluster_rows), dtype=np.int64, count=len(cluster_rows))
+    if residues is None or len(sizes) == 0:
+        return sizes
+
+    rows = np.fromiter(
+        chain.from_iterable(cluster_rows), dtype=np.int64, count=sizes.sum()
+    )
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    return np.add.reduceat(residues[rows].astype(np.int64), starts)
+
+
+def assign_folds(weights, number, strategy="lowest"):
+    """
+    Fold number (1 to `number`) for every cluster.
+
+    snake:  1, 2, ..., N, N, ..., 1, repeated, ignoring cluster sizes.
+    lowest: each cluster, in order, goes to the currently smallest fold.
+    lpt:    like lowest, but the largest clusters are placed first (longest
+            processing time bin packing) for tighter fold balance.
+
+    Ties go to the lowest fold number. Folds are kept in a min-heap, so assigning C
+    clusters takes O(C log N) plus the sort for lpt.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown fold assignment strategy: {strategy}")
+
+    folds = np.zeros(len(weights), dtype=np.int64)
+
+    if strategy == "snake":
+        order = np.concatenate([np.arange(1, number + 1), np.arange(number, 0, -1)])
+        folds[:] = order[np.arange(len(weights)) % len(order)]
+        return folds
+
+    clusters = range(len(weights))
+    if strategy == "lpt":
+        clusters = np.argsort(-np.asarray(weights), kind="stable")
+
+    heap = [(0, fold) for fold in range(1, number + 1)]
+    for cluster in clusters:
+        size, fold = heap[0]
+        folds[cluster] = fold
+        heapq.heapreplace(heap, (size + int(weights[cluster]), fold))
+
+    return folds
+
+
+def assign_folds_joint(cluster_class_weights, class_totals, number):
+    """
+    Fold number (1 to `number`) for every cluster of a clustering over several
+    classes, keeping every class balanced across the folds.
+
+    `cluster_class_weights` has one (classes, weights) pair of arrays per cluster with
+    the size of the cluster in each class it contains. Clusters are placed largest
+    first, each in the fold that is least filled in the classes of that cluster,
+    with fill measured as a fraction of each class total.
+    """
+    class_totals = np.maximum(np.asarray(class_totals, dtype=np.float64), 1)
+    fractions = [
+        weights / class_totals[classes] for classes, weights in cluster_class_weights
+    ]
+    loads = np.zeros((number, len(class_totals)))
+    folds = np.zeros(len(cluster_class_weights), dtype=np.int64)
+
+    order = np.argsort(
+        -np.array([x.sum() for x in fractions], dtype=np.float64), kind="stable"
+    )
+    for cluster in order:
+        classes = cluster_class_weights[cluster][0]
+        fold = int(np.argmin(loads[:, classes] @ fractions[cluster]))
+        loads[fold, classes] += fractions[cluster]
+        folds[cluster] = fold + 1
+
+    return folds
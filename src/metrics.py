@@ -0,0 +1,144 @@
+import cProfile
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, peak memory and child CPU time are reported as null there
+    resource = None
+
+# per-record progress lines are only printed with --verbose
+VERBOSE = False
+STAGES = []
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        "--metrics-json",
+        dest="metrics_json",
+        type=str,
+        default=None,
+        help="Write wall time, CPU time, peak memory and record counts of every stage "
+        "to this JSON file.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write a cProfile dump of the run to this file (read it with pstats or "
+        "snakeviz).",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print a line for every record processed.",
+    )
+
+
+def detail(*args):
+    if VERBOSE:
+        print(*args)
+
+
+def maxrss_mb(usage):
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    return usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def peak_rss_mb(children=False):
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return round(maxrss_mb(resource.getrusage(who)), 1)
+
+
+def child_cpu_seconds():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Stage:
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.records = None
+
+    def add(self, records=1):
+        self.records = (self.records or 0) + records
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Time a stage of a run. Set or `add` to `records` on the yielded Stage to count
+    what it processed. CPU time of child processes (cd-hit) is counted separately,
+    and peak memory is the peak of the process so far, as the OS keeps no per-stage
+    peak.
+    """
+    current = Stage(name, **labels)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    child_cpu = child_cpu_seconds()
+    try:
+        yield current
+    finally:
+        STAGES.append(
+            {
+                "stage": name,
+                **{key: str(value) for key, value in current.labels.items()},
+                "wall_seconds": round(time.perf_counter() - wall, 4),
+                "cpu_seconds": round(time.process_time() - cpu, 4),
+                "child_cpu_seconds": (
+                    None
+                    if child_cpu is None
+                    else round(child_cpu_seconds() - child_cpu, 4)
+                ),
+                "peak_rss_mb": peak_rss_mb(),
+                "child_peak_rss_mb": peak_rss_mb(children=True),
+                "records": current.records,
+            }
+        )
+
+
+def collect():
+    """Hand the stages recorded so far over, e.g. from a worker to its parent."""
+    stages = list(STAGES)
+    STAGES.clear()
+    return stages
+
+
+@contextmanager
+def run(tool, args):
+    """
+    Set up verbosity and profiling from the metrics arguments of an entry point, and
+    write the metrics JSON when it's done.
+    """
+    global VERBOSE
+    VERBOSE = args.verbose
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        with stage("total"):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {Path(args.profile).absolute()}")
+
+        if args.metrics_json:
+            with open(args.metrics_json, "w") as f:
+                json.dump(
+                    {"tool": tool, "argv": sys.argv[1:], "stages": STAGES}, f, indent=2
+                )
+            print(f"Metrics written to {Path(args.metrics_json).absolute()}")
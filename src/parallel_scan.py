@@ -0,0 +1,131 @@
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from .fasta_index import iter_records
+from .fasta_io import compression, decompressed_copy
+
+CHUNK_SIZE = 1 << 26
+# chunks handed to the pool ahead of the one being merged, per worker
+CHUNKS_AHEAD = 2
+
+# set in every worker by _start_worker, so chunks are sent as two offsets
+_buffer = None
+_function = None
+_args = ()
+
+
+def chunk_ranges(buffer, chunk_size=CHUNK_SIZE):
+    """
+    Split a FASTA file (bytes or mmap) into (start, end) byte ranges of about
+    `chunk_size` that start on a ">" header line, so no record spans two ranges.
+    """
+    size = len(buffer)
+    start = 0
+    if buffer[:1] != b">":
+        # skip anything before the first record, like iter_records
+        start = buffer.find(b"\n>") + 1
+        if start == 0:
+            return
+
+    while start < size:
+        end = buffer.find(b"\n>", min(start + chunk_size, size) - 1)
+        end = size if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+def iter_range_records(buffer, start, end):
+    """Yield (offset, lines) like iter_records for the records in buffer[start:end]."""
+    record_start = None
+    lines = []
+    position = start
+
+    while position < end:
+        line_end = buffer.find(b"\n", position, end)
+        line_end = end if line_end == -1 else line_end + 1
+        line = buffer[position:line_end]
+        if line.startswith(b">"):
+            if record_start is not None:
+                yield record_start, lines
+            record_start = position
+            lines = []
+        if record_start is not None:
+            lines.append(line)
+        position = line_end
+
+    if record_start is not None:
+        yield record_start, lines
+
+
+def record_batches(fasta, chunk_size=CHUNK_SIZE):
+    """Lists of (offset, lines) from iter_records of about `chunk_size` bytes each."""
+    batch = []
+    size = 0
+    for record in iter_records(fasta):
+        batch.append(record)
+        size += sum(len(line) for line in record[1])
+        if size >= chunk_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def _start_worker(path, function, args):
+    global _buffer, _function, _args
+    with open(path, "rb") as f:
+        _buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _function = function
+    _args = args
+
+
+def _scan_range(byte_range):
+    return _function(iter_range_records(_buffer, *byte_range), *_args)
+
+
+@contextmanager
+def _mappable(fasta):
+    # compressed files are decompressed to a temporary file to mmap it
+    if compression(fasta) is None:
+        yield Path(fasta)
+        return
+
+    path = decompressed_copy(fasta)
+    try:
+        yield path
+    finally:
+        path.unlink()
+
+
+def scan(fasta, function, *args, jobs=None, chunk_size=CHUNK_SIZE):
+    """
+    Call `function(records, *args)` on chunks of a FASTA file in a process pool and
+    yield the results in input order. `records` yields (offset, lines) like
+    iter_records. Workers mmap the file and only get the byte range of their chunk,
+    and at most a few chunks per worker are in flight, so memory doesn't grow with
+    the file. `function` must be picklable, i.e. defined at module level.
+    """
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or Path(fasta).stat().st_size <= chunk_size:
+        for batch in record_batches(fasta, chunk_size):
+            yield function(batch, *args)
+        return
+
+    with _mappable(fasta) as path:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with buffer, ProcessPoolExecutor(
+            jobs, initializer=_start_worker, initargs=(path, function, args)
+        ) as pool:
+            pending = deque()
+            for byte_range in chunk_ranges(buffer, chunk_size):
+                pending.append(pool.submit(_scan_range, byte_range))
+                if len(pending) >= jobs * CHUNKS_AHEAD:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+import toml
+
+from . import (
+    OTH_cluster_deletion,
+    annotation_cleanup,
+    cluster_deletion_2d,
+    metrics,
+    train_test_split,
+    train_test_split_lowest_cluster,
+    train_test_split_random,
+)
+from .fasta_index import INDEX_SUFFIX, FastaIndex
+from .fasta_io import output_path
+
+CHECKPOINT = "checkpoint.json"
+DIGESTS = "digests.json"
+DIGEST_BUFFER_SIZE = 1 << 24
+# outputs of a stage that are not FASTA files handed to the next stage
+IGNORED_SUFFIXES = (INDEX_SUFFIX, ".clstr", ".incomplete", ".tmp")
+
+
+def validate_path(path):
+    if not Path(path).is_file():
+        raise argparse.ArgumentTypeError(f"File {path} does not exist.")
+    return path
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+        Run annotation_cleanup, cluster_deletion, the train/test splits and
+        cluster_deletion_2d as the stages of one pipeline described in a TOML config.
+        Every finished stage is checkpointed by the digests of its inputs and options,
+        so a failed or edited run resumes from the first stage whose inputs changed.
+        """,
+        formatter_class=argparse.HelpFormatter,
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=validate_path,
+        required=True,
+        help="Path to the pipeline config file.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="Directory for the stage outputs and checkpoints. Overrides `work_dir` in "
+        "the config. Default: pipeline next to the config file",
+    )
+    parser.add_argument(
+        "--rerun",
+        type=lambda x: x.split(","),
+        default=[],
+        help="Stages to run again even if they have a checkpoint, separated by commas. "
+        "Stages that depend on them run again if their outputs change.",
+    )
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+def single(name, key, paths):
+    if len(paths) != 1:
+        raise ValueError(f"Stage {name} takes a single file as `{key}`, got {len(paths)}")
+    return paths[0]
+
+
+def link_inputs(paths, directory):
+    """Symlink `paths` into `directory` for the tools that split a whole directory."""
+    directory.mkdir()
+    for path in paths:
+        link = directory / path.name
+        if link.exists():
+            raise ValueError(f"Two inputs are named {path.name}, rename one of them")
+        link.symlink_to(path)
+    return directory
+
+
+def concatenated(paths, output):
+    if len(paths) == 1:
+        return paths[0]
+    with open(output, "wb") as f:
+        cluster_deletion_2d.concatenate(paths, f)
+    return output
+
+
+def outputs(patterns):
+    found = sorted({path for pattern in patterns for path in Path().glob(pattern)})
+    return [x for x in found if x.is_file() and not x.name.endswith(IGNORED_SUFFIXES)]
+
+
+def run_annotation_cleanup(name, inputs, argv, compress):
+    fasta = single(name, "fasta", inputs["fasta"])
+    output = output_path(f"{name}.fasta", compress)
+    args = annotation_cleanup.get_args(["-f", str(fasta), "-o", f"{name}.fasta", *argv])
+    annotation_cleanup.cleanup(args)
+    return [output]
+
+
+def run_cluster_deletion(name, inputs, argv, compress):
+    target = single(name, "target", inputs["target"])
+    reference = concatenated(inputs["reference"], Path(f"{name}_reference.fasta"))
+    output = output_path(f"{name}.fasta", compress)
+    args = OTH_cluster_deletion.get_args(
+        ["-t", str(target), "-r", str(reference), "-o", f"{name}.fasta", "-jid", name, *argv]
+    )
+    OTH_cluster_deletion.cluster_deletion(args)
+    if len(inputs["reference"]) > 1:
+        reference.unlink()
+        Path(f"{reference}{INDEX_SUFFIX}").unlink(missing_ok=True)
+    return [output]
+
+
+def split_inputs(inputs):
+    if len(inputs["fasta"]) == 1:
+        return ["-f", str(inputs["fasta"][0])]
+    return ["-d", str(link_inputs(inputs["fasta"], Path("inputs")))]
+
+
+def run_train_test_split(name, inputs, argv, compress):
+    train_test_split.split(train_test_split.get_args([*split_inputs(inputs), *argv]))
+    return outputs(["[0-9]*_*.fasta*"])
+
+
+def run_train_test_split_lowest_cluster(name, inputs, argv, compress):
+    args = train_test_split_lowest_cluster.get_args([*split_inputs(inputs), *argv])
+    train_test_split_lowest_cluster.split(args)
+    return outputs(["[0-9]*_*.fasta*"])
+
+
+def run_train_test_split_random(name, inputs, argv, compress):
+    fasta = single(name, "fasta", inputs["fasta"])
+    train_test_split_random.random_split(
+        train_test_split_random.get_args(["-f", str(fasta), *argv])
+    )
+    return outputs(["[0-9]*_*.fasta*"])
+
+
+def run_cluster_deletion_2d(name, inputs, argv, compress):
+    target_dir = link_inputs(inputs["fasta"], Path("inputs"))
+    cluster_deletion_2d.cluster_deletion_2d(
+        cluster_deletion_2d.get_args(["-d", str(target_dir), *argv])
+    )
+    return outputs(["*_removed_2d_40pct*"])
+
+
+# tool -> (function running it in the stage directory, its input keys)
+TOOLS = {
+    "annotation_cleanup": (run_annotation_cleanup, ["fasta"]),
+    "cluster_deletion": (run_cluster_deletion, ["target", "reference"]),
+    "train_test_split": (run_train_test_split, ["fasta"]),
+    "train_test_split_lowest_cluster": (run_train_test_split_lowest_cluster, ["fasta"]),
+    "train_test_split_random": (run_train_test_split_random, ["fasta"]),
+    "cluster_deletion_2d": (run_cluster_deletion_2d, ["fasta"]),
+}
+# tools that read their inputs through a FastaIndex
+INDEXED_TOOLS = {"cluster_deletion", "train_test_split", "train_test_split_lowest_cluster"}
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(DIGEST_BUFFER_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DigestCache:
+    """Content digests of the pipeline's input files, rehashed when their size or mtime changes."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.digests = {}
+        if self.path.is_file():
+            with open(self.path, "r") as f:
+                self.digests = json.load(f)
+
+    def digest(self, path):
+        path = Path(path).resolve()
+        stat = path.stat()
+        source = [stat.st_size, stat.st_mtime_ns]
+        saved = self.digests.get(str(path))
+        if saved is None or saved["source"] != source:
+            saved = {"source": source, "digest": file_digest(path)}
+            self.digests[str(path)] = saved
+        return saved["digest"]
+
+    def save(self):
+        write_json(self.path, self.digests)
+
+
+def write_json(path, data):
+    # write next to the destination and rename, so a killed run never leaves half a file
+    temp_path = Path(f"{path}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def load_config(config_path):
+    with open(config_path, "r") as f:
+        config = toml.load(f)
+
+    stages = config.get("stages", {})
+    if not stages:
+        raise ValueError(f"No [stages] in {config_path}")
+    for name, stage in stages.items():
+        if stage.get("tool") not in TOOLS:
+            raise ValueError(
+                f"Stage {name} has unknown tool {stage.get('tool')!r}, "
+                f"choose from: {', '.join(TOOLS)}"
+            )
+        for key in TOOLS[stage["tool"]][1]:
+            if key not in stage:
+                raise ValueError(f"Stage {name} is missing its `{key}` input")
+            if isinstance(stage[key], str):
+                stage[key] = [stage[key]]
+
+    return config
+
+
+def stage_order(stages):
+    """Stages sorted so that every stage comes after the stages it reads from."""
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Stages depend on each other: {' -> '.join(path + [name])}")
+        state[name] = "visiting"
+        for dependency in dependencies(stages[name], stages):
+            visit(dependency, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return order
+
+
+def dependencies(stage, stages):
+    keys = TOOLS[stage["tool"]][1]
+    return [value for key in keys for value in stage[key] if value in stages]
+
+
+def option_argv(options, config_dir, digests):
+    """
+    Command line arguments of the tool for the `options` table of a stage, and the
+    digests of the files they name. Options that name a file relative to the config
+    file, like the annotation config, are made absolute.
+    """
+    argv = []
+    files = {}
+    for key, value in options.items():
+        flag = f"-{key}" if len(key) == 1 else f"--{key}"
+        if value is True:
+            argv.append(flag)
+            continue
+        if value is False:
+            continue
+
+        values = list(value) if isinstance(value, list) else [value]
+        for i, x in enumerate(values):
+            if isinstance(x, str) and (config_dir / x).is_file():
+                values[i] = str((config_dir / x).resolve())
+                files[values[i]] = digests.digest(values[i])
+        argv.extend([flag, *map(str, values)])
+
+    return argv, files
+
+
+def stage_key(tool, argv, files, inputs):
+    key = hashlib.blake2b(digest_size=16)
+    key.update(
+        json.dumps(
+            {"tool": tool, "argv": argv, "files": files, "inputs": inputs}, sort_keys=True
+        ).encode()
+    )
+    return key.hexdigest()
+
+
+def load_checkpoint(stage_dir):
+    checkpoint = stage_dir / CHECKPOINT
+    if not checkpoint.is_file():
+        return None
+    with open(checkpoint, "r") as f:
+        saved = json.load(f)
+    if not all((stage_dir / x["path"]).is_file() for x in saved["outputs"]):
+        return None
+    return saved
+
+
+def remove_old_runs(work_dir, name, stage_dir):
+    # earlier runs of the stage, with other inputs or options
+    for path in work_dir.iterdir():
+        if path != stage_dir and re.fullmatch(rf"{re.escape(name)}-[0-9a-f]{{16}}", path.name):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run_pipeline(config_path, work_dir=None, rerun=()):
+    config_path = Path(config_path).resolve()
+    config_dir = config_path.parent
+    config = load_config(config_path)
+    stages = config["stages"]
+    work_dir = Path(work_dir or config_dir / config.get("work_dir", "pipeline")).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    unknown = set(rerun) - set(stages)
+    if unknown:
+        raise ValueError(f"Unknown stages to rerun: {', '.join(sorted(unknown))}")
+
+    order = stage_order(stages)
+    indexed = {
+        x
+        for name in order
+        if stages[name]["tool"] in INDEXED_TOOLS
+        for x in dependencies(stages[name], stages)
+    }
+    digests = DigestCache(work_dir / DIGESTS)
+    # stage -> [(path, digest)] of its outputs
+    results = {}
+
+    for name in order:
+        stage = stages[name]
+        tool = stage["tool"]
+        function, keys = TOOLS[tool]
+
+        inputs = {}
+        input_digests = {}
+        for key in keys:
+            inputs[key] = []
+            input_digests[key] = []
+            for value in stage[key]:
+                if value in stages:
+                    inputs[key].extend(path for path, _ in results[value])
+                    input_digests[key].extend(digest for _, digest in results[value])
+                else:
+                    path = (config_dir / value).resolve()
+                    if not path.is_file():
+                        raise ValueError(f"Input {value} of stage {name} does not exist")
+                    inputs[key].append(path)
+                    input_digests[key].append(digests.digest(path))
+        digests.save()
+
+        options = dict(stage.get("options", {}))
+        argv, files = option_argv(options, config_dir, digests)
+        key = stage_key(tool, argv, files, input_digests)
+        stage_dir = work_dir / f"{name}-{key[:16]}"
+
+        checkpoint = None if name in rerun else load_checkpoint(stage_dir)
+        if checkpoint is not None:
+            print(f"Stage {name}: up to date in {stage_dir}")
+            results[name] = [(stage_dir / x["path"], x["digest"]) for x in checkpoint["outputs"]]
+            continue
+
+        print(f"Stage {name}: running {tool} in {stage_dir}")
+        # a directory without a checkpoint is left over from a failed run
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        stage_dir.mkdir()
+
+        with metrics.stage(name, tool=tool) as current, working_directory(stage_dir):
+            produced = function(name, inputs, argv, options.get("compress"))
+            if not produced:
+                raise RuntimeError(f"Stage {name} produced no output files")
+
+            results[name] = []
+            for path in produced:
+                # later stages load the saved index instead of parsing the file again
+                if name in indexed:
+                    FastaIndex.load_or_build(path).close()
+                results[name].append((stage_dir / path, file_digest(path)))
+            current.records = len(produced)
+
+        write_json(
+            stage_dir / CHECKPOINT,
+            {
+                "tool": tool,
+                "argv": argv,
+                "inputs": {k: [str(x) for x in v] for k, v in inputs.items()},
+                "outputs": [
+                    {"path": path.name, "digest": digest} for path, digest in results[name]
+                ],
+            },
+        )
+        remove_old_runs(work_dir, name, stage_dir)
+
+    print("Pipeline done")
+    for name in order:
+        print(f"{name}:")
+        for path, _ in results[name]:
+            print(f"\t{path}")
+    return results
+
+
+def main():
+    args = get_args()
+    with metrics.run("pipeline", args):
+        run_pipeline(args.config, args.work_dir, args.rerun)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
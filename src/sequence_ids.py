@@ -0,0 +1,51 @@
+from hashlib import blake2b
+
+# 10 bytes -> 20 hex characters, short enough to survive cd-hit's default -d 20
+ID_BYTES = 10
+FINGERPRINT_BYTES = 8
+
+
+def _residues(seq):
+    if isinstance(seq, bytes):
+        return seq
+    if isinstance(seq, str):
+        return seq.encode()
+    return bytes(seq)
+
+
+def _digest(seq):
+    return blake2b(_residues(seq), digest_size=ID_BYTES + FINGERPRINT_BYTES).digest()
+
+
+def sequence_id(seq):
+    """
+    Content-addressed ID of a sequence. Unlike `hash()` it is the same in every
+    process and on every machine, so cluster files can be reused between runs.
+    """
+    return _digest(seq)[:ID_BYTES].hex()
+
+
+class SequenceIdRegistry:
+    """
+    Hands out sequence IDs and raises if two different sequences end up with the
+    same ID, instead of letting one silently replace the other in a lookup.
+    """
+
+    def __init__(self):
+        self._fingerprints = {}
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def __contains__(self, seq_id):
+        return seq_id in self._fingerprints
+
+    def assign(self, seq):
+        digest = _digest(seq)
+        seq_id = digest[:ID_BYTES].hex()
+        fingerprint = digest[ID_BYTES:]
+
+        known = self._fingerprints.setdefault(seq_id, fingerprint)
+        if known != fingerprint:
+            raise ValueError(f"Sequence ID collision between different sequences: {seq_id}")
+        return seq_id
@@ -0,0 +1,71 @@
+from array import array
+
+import numpy as np
+
+from .fasta_io import LINE_WIDTH, write_record
+
+
+class SequenceStore:
+    """
+    Headers and residues of records held in memory, packed into two contiguous byte
+    buffers with the end offset of every record in an array. Records can be given a
+    hex ID (a sequence or header digest) to `find` them by, stored as raw bytes, so a
+    record costs its bytes, 16 bytes of offsets and its ID, instead of the hundreds of
+    bytes of a SeqRecord or a tuple of bytes objects.
+    """
+
+    def __init__(self, id_bytes=None):
+        self.id_bytes = id_bytes
+        self._headers = bytearray()
+        self._residues = bytearray()
+        self._header_ends = array("Q")
+        self._residue_ends = array("Q")
+        self._ids = bytearray()
+        self._order = None
+
+    def __len__(self):
+        return len(self._header_ends)
+
+    def add(self, header, residues, seq_id=None):
+        """Append a record and return its row, the index records are read back by."""
+        if (seq_id is None) != (self.id_bytes is None):
+            raise ValueError("Give every record an ID, or none, depending on id_bytes")
+        if seq_id is not None:
+            seq_id = bytes.fromhex(seq_id)
+            if len(seq_id) != self.id_bytes:
+                raise ValueError(f"Expected {self.id_bytes} byte IDs, got {len(seq_id)}")
+            self._ids += seq_id
+            self._order = None
+
+        self._headers += header
+        self._residues += residues
+        self._header_ends.append(len(self._headers))
+        self._residue_ends.append(len(self._residues))
+        return len(self) - 1
+
+    def header(self, row):
+        start = self._header_ends[row - 1] if row else 0
+        return bytes(self._headers[start : self._header_ends[row]])
+
+    def residues(self, row):
+        start = self._residue_ends[row - 1] if row else 0
+        return bytes(self._residues[start : self._residue_ends[row]])
+
+    def find(self, seq_id):
+        """Row of the first record added with `seq_id`."""
+        if self.id_bytes is None:
+            raise KeyError(seq_id)
+        if self._order is None:
+            ids = np.frombuffer(self._ids, dtype=f"S{self.id_bytes}")
+            self._order = np.argsort(ids, kind="stable")
+            self._sorted_ids = ids[self._order]
+
+        # numpy drops trailing NUL bytes from S items, compare the same way
+        key = bytes.fromhex(seq_id).rstrip(b"\0")
+        i = np.searchsorted(self._sorted_ids, key)
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != key:
+            raise KeyError(seq_id)
+        return int(self._order[i])
+
+    def write_record(self, handle, row, width=LINE_WIDTH):
+        write_record(handle, self.header(row), self.residues(row), width)
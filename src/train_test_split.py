@@ -2,16 +2,29 @@
 
 import argparse
 import os
-import re
-import subprocess
 import sys
 import tempfile
 from collections import defaultdict
-from copy import copy
-from itertools import cycle
 from pathlib import Path
 
-from Bio import SeqIO
+import numpy as np
+
+from . import metrics
+from .batch import fasta_files, run_batch
+from .cd_hit_runner import add_cd_hit_arguments
+from .cluster_cache import ClusterCache, add_cache_arguments, cached_clusters
+from .clustering import add_backend_arguments, backend_params, cache_params, cluster
+from .fasta_index import FastaIndex
+from .fasta_io import add_compression_argument, fasta_stem, output_path, xopen
+from .fold_assignment import (
+    STRATEGIES,
+    WEIGHTS,
+    assign_folds,
+    assign_folds_joint,
+    cluster_weights,
+)
+
+CD_HIT_PARAMS = {"c": 0.4, "n": 2, "d": 0, "sc": 1}
 
 
 def validate_path(path):
@@ -21,23 +34,45 @@ def validate_path(path):
     return path
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description=r"""
         Split a fasta file into N groups with no more than 40% sequence homology.
         """,
         formatter_class=argparse.HelpFormatter,
     )
-    parser.add_argument(
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
         "-f",
         "--fasta",
         type=validate_path,
-        required=True,
         help="Path to the FASTA file to be cleaned up.",
     )
+    inputs.add_argument(
+        "-d",
+        "--fasta_dir",
+        type=validate_path,
+        help="Directory of FASTA files to split, one class per file.",
+    )
     parser.add_argument(
         "-n", "--Number", type=int, default=11, help="Number of groups to split into."
     )
+    parser.add_argument(
+        "-s",
+        "--strategy",
+        choices=STRATEGIES,
+        default="snake",
+        help="How clusters are assigned to groups: snake (round-robin there and back), "
+        "lowest (smallest group first) or lpt (largest cluster to the smallest group "
+        "first). Default: snake",
+    )
+    parser.add_argument(
+        "-w",
+        "--weight",
+        choices=WEIGHTS,
+        default="sequences",
+        help="Measure group sizes in sequences or residues. Default: sequences",
+    )
     parser.add_argument(
         "--cd-hit",
         type=str,
@@ -45,96 +80,276 @@ def get_args():
         default="cd-hit",
         help="Path to the cd-hit program.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of files to split at once with --fasta_dir. "
+        "Default: one per thread",
+    )
+    parser.add_argument(
+        "--joint",
+        action="store_true",
+        help="With --fasta_dir, cluster all files together once and assign each "
+        "cluster to the same group in every file, keeping every file balanced across "
+        "groups.",
+    )
 
-    return parser.parse_args()
-
+    add_backend_arguments(parser)
+    add_cache_arguments(parser)
+    add_cd_hit_arguments(parser)
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
 
-def call_cd_hit(fasta, cd_hit):
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_file_path = temp_file.name
+    args = parser.parse_args(argv)
+    if args.joint and args.fasta_dir is None:
+        parser.error("--joint requires --fasta_dir")
 
-        cmd = (
-            f"{cd_hit} -i {fasta} -o {temp_file_path} -c 0.4 -n 2 -d 0 -M 0 -T 0 -sc 1"
-        )
-        print(f"Running cd-hit with command: {cmd}")
+    return args
 
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        print(f"Writing cd-hit output to temporary file {temp_file_path}...")
 
-    # print(result.stdout)
-    return temp_file_path
+def call_cd_hit(
+    fasta,
+    cd_hit,
+    threads=0,
+    backend="cd-hit",
+    memory=0,
+    timeout=None,
+    params=CD_HIT_PARAMS,
+):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    print(f"Writing cd-hit output to temporary file {temp_file_path}...")
+    return cluster(
+        fasta, temp_file_path, params, backend, cd_hit, threads, memory, timeout
+    )
 
 
 def hash_headers(fasta):
-    hash_lookup = {}
-    hashed_records = []
-
     print("Hashing headers...")
-    for record in SeqIO.parse(fasta, "fasta"):
-        hash_value = hash(record.seq)
-        hash_lookup[str(hash_value)] = copy(record)
-
-        record.id = str(hash_value)
-        record.description = ""
-        hashed_records.append(record)
-
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+    with metrics.stage("hash", file=fasta) as stage:
+        fasta_index = FastaIndex.load_or_build(fasta)
+        unique_rows = fasta_index.unique_rows()
+        stage.records = len(fasta_index)
+    print(f"Collapsed {len(fasta_index) - len(unique_rows)} duplicate sequences")
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file, metrics.stage(
+        "write temp", file=fasta
+    ) as stage:
         temp_file_path = temp_file.name
         print(f"Writing hashed records to temporary file {temp_file_path}...")
-        SeqIO.write(hashed_records, temp_file_path, "fasta")
+        fasta_index.write_renamed(temp_file, lambda seq_id: seq_id, unique_rows)
+        stage.records = len(unique_rows)
 
-    return hash_lookup, Path(temp_file_path)
+    return fasta_index, Path(temp_file_path)
 
 
-def fetch_clusters(cd_hit_output):
-    print(f"Opening {cd_hit_output}")
-    hash_pattern = re.compile("\d+\s\d+aa,\s>(?P<hash_str>-?[0-9]*)\.\.\.")
+def fetch_clusters(clusters):
+    for cluster_number, hashes in enumerate(clusters):
+        for hash_str in hashes:
+            yield cluster_number, hash_str
 
-    with open(cd_hit_output + ".clstr") as file:
-        file = file.read()
-        clusters = file.split(">Cluster")[1:]
 
-    print(f"Parsing {len(clusters)} clusters from cd-hit output")
-    for cluster_number, cluster in enumerate(clusters):
-        cluster = [x.strip() for x in cluster.split("\n") if x.strip() != ""][1:]
-        hashes = [hash_pattern.match(line).group("hash_str") for line in cluster]
+def split_fasta(
+    fasta,
+    number=11,
+    cd_hit="cd-hit",
+    threads=0,
+    cache_dir=None,
+    no_cache=False,
+    strategy="snake",
+    weight="sequences",
+    backend="cd-hit",
+    compress=None,
+    memory=0,
+    timeout=None,
+    word_filter=None,
+):
+    fasta_index, temp_file_path = hash_headers(fasta)
+
+    # Call the cd-hit function with the temporary file, unless the clusters are cached
+    cache = None if no_cache else ClusterCache(cache_dir)
+    params = backend_params(CD_HIT_PARAMS, backend, word_filter)
+    with metrics.stage("cluster", file=fasta):
+        clusters, cd_hit_output = cached_clusters(
+            cache,
+            temp_file_path,
+            cache_params(params, backend),
+            lambda: call_cd_hit(
+                temp_file_path, cd_hit, threads, backend, memory, timeout, params
+            ),
+        )
 
-        for hash_str in hashes:
-            yield cluster_number, hash_str
+    # Parse the cd-hit output file
+    cluster_rows = []
+    with metrics.stage("parse clusters", file=fasta) as stage:
+        for cluster_number, hash_str in fetch_clusters(clusters):
+            if cluster_number == len(cluster_rows):
+                cluster_rows.append([])
+            cluster_rows[-1].extend(fasta_index.find_all(hash_str))
+        stage.records = len(cluster_rows)
+
+    # Assign whole clusters to groups
+    with metrics.stage("assign folds", file=fasta) as stage:
+        weights = cluster_weights(
+            cluster_rows, fasta_index.residues if weight == "residues" else None
+        )
+        outputs = defaultdict(list)
+        for split_number, rows in zip(
+            assign_folds(weights, number, strategy), cluster_rows
+        ):
+            outputs[split_number].extend(rows)
+        stage.records = len(cluster_rows)
 
+    # Write the output files
+    print("Writing output files...")
+    with metrics.stage("write outputs", file=fasta) as stage:
+        for key, records in outputs.items():
+            output_file = output_path(f"{key}_{fasta_stem(fasta)}.fasta", compress)
+            print(f"\tWriting {len(records)} records to {output_file}")
+            with xopen(output_file, "wb") as f:
+                fasta_index.write_records(records, f)
+            stage.add(len(records))
 
-def main():
-    args = get_args()
+    fasta_index.close()
 
-    hash_lookup, temp_file_path = hash_headers(args.fasta)
+    # Remove the temporary files after it's no longer needed
+    os.remove(temp_file_path)
+    if cd_hit_output is not None:
+        os.remove(cd_hit_output)
+
+
+def split_joint(
+    files,
+    number=11,
+    cd_hit="cd-hit",
+    threads=0,
+    cache_dir=None,
+    no_cache=False,
+    weight="sequences",
+    backend="cd-hit",
+    compress=None,
+    memory=0,
+    timeout=None,
+    word_filter=None,
+):
+    with metrics.stage("hash") as stage:
+        fasta_indexes = [FastaIndex.load_or_build(fasta) for fasta in files]
+        stage.records = sum(map(len, fasta_indexes))
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file, metrics.stage(
+        "write temp"
+    ) as stage:
+        temp_file_path = Path(temp_file.name)
+        print(f"Writing hashed records of {len(files)} files to {temp_file_path}...")
+        for class_number, fasta_index in enumerate(fasta_indexes):
+            unique_rows = fasta_index.unique_rows()
+            fasta_index.write_renamed(
+                temp_file, lambda seq_id: f"{class_number}@@@{seq_id}", unique_rows
+            )
+            stage.add(len(unique_rows))
+
+    # Call the cd-hit function once for all files, unless the clusters are cached
+    cache = None if no_cache else ClusterCache(cache_dir)
+    params = backend_params(CD_HIT_PARAMS, backend, word_filter)
+    with metrics.stage("cluster"):
+        clusters, cd_hit_output = cached_clusters(
+            cache,
+            temp_file_path,
+            cache_params(params, backend),
+            lambda: call_cd_hit(
+                temp_file_path, cd_hit, threads, backend, memory, timeout, params
+            ),
+        )
 
-    # Call the cd-hit function with the temporary file
-    cd_hit_output = call_cd_hit(temp_file_path, args.cd_hit)
+    # Parse the cd-hit output file into (class number, row) pairs per cluster
+    cluster_members = []
+    with metrics.stage("parse clusters") as stage:
+        for cluster_number, member in fetch_clusters(clusters):
+            if cluster_number == len(cluster_members):
+                cluster_members.append([])
+            class_number, hash_str = member.split("@@@")
+            class_number = int(class_number)
+            cluster_members[-1].extend(
+                (class_number, row)
+                for row in fasta_indexes[class_number].find_all(hash_str)
+            )
+        stage.records = len(cluster_members)
+
+    # Assign whole clusters to the same group in every file
+    cluster_class_weights = []
+    class_totals = np.zeros(len(fasta_indexes), dtype=np.int64)
+    for members in cluster_members:
+        class_weights = defaultdict(int)
+        for class_number, row in members:
+            class_weights[class_number] += (
+                int(fasta_indexes[class_number].residues[row])
+                if weight == "residues"
+                else 1
+            )
+        classes = np.fromiter(class_weights.keys(), dtype=np.int64)
+        weights = np.fromiter(class_weights.values(), dtype=np.int64)
+        class_totals[classes] += weights
+        cluster_class_weights.append((classes, weights))
 
-    # Parse the cd-hit output file
     outputs = defaultdict(list)
-    cluster_write_order = cycle(
-        list(range(1, args.Number + 1)) + list(range(args.Number, 0, -1))
-    )
-    previous_cluster = None
-    file_number = None
-    for cluster_number, hash_str in fetch_clusters(cd_hit_output):
-        original_record = hash_lookup[hash_str]
-        if cluster_number != previous_cluster:
-            file_number = next(cluster_write_order)
-            previous_cluster = cluster_number
-        outputs[file_number].append(original_record)
+    folds = assign_folds_joint(cluster_class_weights, class_totals, number)
+    for split_number, members in zip(folds, cluster_members):
+        for class_number, row in members:
+            outputs[class_number, split_number].append(row)
 
     # Write the output files
     print("Writing output files...")
-    for key, records in outputs.items():
-        output_file = f"{key}_{args.fasta.stem}.fasta"
-        print(f"\tWriting {len(records)} records to {output_file}")
-        SeqIO.write(records, output_file, "fasta")
+    with metrics.stage("write outputs") as stage:
+        for (class_number, key), records in sorted(outputs.items()):
+            fasta_index = fasta_indexes[class_number]
+            output_file = output_path(
+                f"{key}_{fasta_stem(fasta_index.fasta)}.fasta", compress
+            )
+            print(f"\tWriting {len(records)} records to {output_file}")
+            with xopen(output_file, "wb") as f:
+                fasta_index.write_records(records, f)
+            stage.add(len(records))
+
+    for fasta_index in fasta_indexes:
+        fasta_index.close()
 
     # Remove the temporary files after it's no longer needed
     os.remove(temp_file_path)
-    os.remove(cd_hit_output)
+    if cd_hit_output is not None:
+        os.remove(cd_hit_output)
+
+
+def main():
+    args = get_args()
+    with metrics.run("train_test_split", args):
+        split(args)
+
+
+def split(args):
+    options = dict(
+        number=args.Number,
+        cd_hit=args.cd_hit,
+        cache_dir=args.cache_dir,
+        no_cache=args.no_cache,
+        strategy=args.strategy,
+        weight=args.weight,
+        backend=args.backend,
+        compress=args.compress,
+        timeout=args.timeout,
+        word_filter=args.word_filter,
+    )
+    resources = dict(threads=args.threads, memory=args.memory)
+    if args.joint:
+        options.pop("strategy")
+        split_joint(fasta_files(args.fasta_dir), **resources, **options)
+    elif args.fasta_dir is not None:
+        run_batch(
+            split_fasta, fasta_files(args.fasta_dir), args.jobs, **resources, **options
+        )
+    else:
+        split_fasta(args.fasta, **resources, **options)
 
 
 if __name__ == "__main__":
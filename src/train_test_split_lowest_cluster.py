@@ -2,16 +2,21 @@
 
 import argparse
 import os
-import re
-import subprocess
 import sys
 import tempfile
 from collections import defaultdict
-from copy import copy
-from itertools import cycle
 from pathlib import Path
 
-from Bio import SeqIO
+from . import metrics
+from .batch import fasta_files, run_batch
+from .cd_hit_runner import add_cd_hit_arguments
+from .cluster_cache import ClusterCache, add_cache_arguments, cached_clusters
+from .clustering import add_backend_arguments, backend_params, cache_params, cluster
+from .fasta_index import FastaIndex
+from .fasta_io import add_compression_argument, fasta_stem, output_path, xopen
+from .fold_assignment import STRATEGIES, WEIGHTS, assign_folds, cluster_weights
+
+CD_HIT_PARAMS = {"c": 0.4, "n": 2, "d": 0, "sc": 1}
 
 
 def validate_path(path):
@@ -21,23 +26,45 @@ def validate_path(path):
     return path
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description=r"""
         Split a fasta file into N groups with no more than 40% sequence homology.
         """,
         formatter_class=argparse.HelpFormatter,
     )
-    parser.add_argument(
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
         "-f",
         "--fasta",
         type=validate_path,
-        required=True,
         help="Path to the FASTA file to be split.",
     )
+    inputs.add_argument(
+        "-d",
+        "--fasta_dir",
+        type=validate_path,
+        help="Directory of FASTA files to split, one class per file.",
+    )
     parser.add_argument(
         "-n", "--Number", type=int, default=11, help="Number of groups to split into."
     )
+    parser.add_argument(
+        "-s",
+        "--strategy",
+        choices=STRATEGIES,
+        default="lowest",
+        help="How clusters are assigned to groups: snake (round-robin there and back), "
+        "lowest (smallest group first) or lpt (largest cluster to the smallest group "
+        "first). Default: lowest",
+    )
+    parser.add_argument(
+        "-w",
+        "--weight",
+        choices=WEIGHTS,
+        default="sequences",
+        help="Measure group sizes in sequences or residues. Default: sequences",
+    )
     parser.add_argument(
         "--cd-hit",
         type=str,
@@ -46,112 +73,182 @@ def get_args():
         help="Path to the cd-hit program.",
     )
     parser.add_argument(
-        "-notmp", "--no_temp_dir", action="store_true", help="Don't use a temporary directory for intermediate files."
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of files to split at once with --fasta_dir. "
+        "Default: one per thread",
     )
-
-    return parser.parse_args()
-
-
-def call_cd_hit(fasta, cd_hit, no_tmp_dir=False):
+    parser.add_argument(
+        "-notmp",
+        "--no_temp_dir",
+        action="store_true",
+        help="Don't use a temporary directory for intermediate files.",
+    )
+    add_backend_arguments(parser)
+    add_cache_arguments(parser)
+    add_cd_hit_arguments(parser)
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def call_cd_hit(
+    fasta,
+    cd_hit,
+    no_tmp_dir=False,
+    threads=0,
+    backend="cd-hit",
+    memory=0,
+    timeout=None,
+    params=CD_HIT_PARAMS,
+):
     if no_tmp_dir:
-        Path('cd_hit_temp').mkdir(exist_ok=True)
-        file_path = str(Path('cd_hit_temp') / (str(fasta.name) + '_clustered'))
-        cmd = (
-            f"{cd_hit} -i {fasta} -o {file_path} -c 0.4 -n 2 -d 0 -M 0 -T 0 -sc 1"
-        )
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        print(f"Running cd-hit with command: {cmd}")
-        return file_path
-
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_file_path = temp_file.name
-        cmd = (
-            f"{cd_hit} -i {fasta} -o {temp_file_path} -c 0.4 -n 2 -d 0 -M 0 -T 0 -sc 1"
-        )
-        print(f"Running cd-hit with command: {cmd}")
+        Path("cd_hit_temp").mkdir(exist_ok=True)
+        file_path = str(Path("cd_hit_temp") / (str(fasta.name) + "_clustered"))
+    else:
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            file_path = temp_file.name
+        print(f"Writing cd-hit output to temporary file {file_path}...")
 
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        print(f"Writing cd-hit output to temporary file {temp_file_path}...")
-        return temp_file_path
+    return cluster(fasta, file_path, params, backend, cd_hit, threads, memory, timeout)
 
 
 def hash_headers(fasta):
-    hash_lookup = {}
-    hashed_records = []
-
     print("Hashing headers...")
-    for record in SeqIO.parse(fasta, "fasta"):
-        hash_value = hash(record.seq)
-        hash_lookup[str(hash_value)] = copy(record)
-
-        record.id = str(hash_value)
-        record.description = ""
-        hashed_records.append(record)
-
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+    with metrics.stage("hash", file=fasta) as stage:
+        fasta_index = FastaIndex.load_or_build(fasta)
+        unique_rows = fasta_index.unique_rows()
+        stage.records = len(fasta_index)
+    print(f"Collapsed {len(fasta_index) - len(unique_rows)} duplicate sequences")
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file, metrics.stage(
+        "write temp", file=fasta
+    ) as stage:
         temp_file_path = temp_file.name
         print(f"Writing hashed records to temporary file {temp_file_path}...")
-        SeqIO.write(hashed_records, temp_file_path, "fasta")
+        fasta_index.write_renamed(temp_file, lambda seq_id: seq_id, unique_rows)
+        stage.records = len(unique_rows)
 
-    return hash_lookup, Path(temp_file_path)
+    return fasta_index, Path(temp_file_path)
 
 
-def fetch_clusters(cd_hit_output):
-    print(f"Opening {cd_hit_output}")
-    hash_pattern = re.compile("\d+\s\d+aa,\s>(?P<hash_str>-?[0-9]*)\.\.\.")
-
-    with open(cd_hit_output + ".clstr") as file:
-        file = file.read()
-        clusters = file.split(">Cluster")[1:]
-
-    print(f"Parsing {len(clusters)} clusters from cd-hit output")
-    for cluster_number, cluster in enumerate(clusters):
-        cluster = [x.strip() for x in cluster.split("\n") if x.strip() != ""][1:]
-        hashes = [hash_pattern.match(line).group("hash_str") for line in cluster]
-        print(f"\tFound {len(hashes)} sequences in cluster {cluster_number}")
+def fetch_clusters(clusters):
+    for cluster_number, hashes in enumerate(clusters):
+        metrics.detail(f"\tFound {len(hashes)} sequences in cluster {cluster_number}")
 
         yield hashes
 
 
-def lowest_split(outputs, expected_splits):
-    if len(outputs) < expected_splits:
-        return len(outputs.keys()) + 1
-
-    min_size = min(len(v) for v in outputs.values())
-    for key, records in outputs.items():
-        if len(records) == min_size:
-            return key
-
-
-def main():
-    args = get_args()
-
-    hash_lookup, temp_file_path = hash_headers(args.fasta)
-
-    # Call the cd-hit function with the temporary file
-    cd_hit_output = call_cd_hit(temp_file_path, args.cd_hit, args.no_temp_dir)
+def split_fasta(
+    fasta,
+    number=11,
+    cd_hit="cd-hit",
+    threads=0,
+    cache_dir=None,
+    no_cache=False,
+    no_temp_dir=False,
+    strategy="lowest",
+    weight="sequences",
+    backend="cd-hit",
+    compress=None,
+    memory=0,
+    timeout=None,
+    word_filter=None,
+):
+    fasta_index, temp_file_path = hash_headers(fasta)
+
+    # Call the cd-hit function with the temporary file, unless the clusters are cached
+    cache = None if no_cache else ClusterCache(cache_dir)
+    params = backend_params(CD_HIT_PARAMS, backend, word_filter)
+    with metrics.stage("cluster", file=fasta):
+        clusters, cd_hit_output = cached_clusters(
+            cache,
+            temp_file_path,
+            cache_params(params, backend),
+            lambda: call_cd_hit(
+                temp_file_path,
+                cd_hit,
+                no_temp_dir,
+                threads,
+                backend,
+                memory,
+                timeout,
+                params,
+            ),
+        )
 
     # Parse the cd-hit output file
-    outputs = defaultdict(list)
-
-    for hash_list in fetch_clusters(cd_hit_output):
-        split_number = lowest_split(outputs, args.Number)
-        print(f"\t\tAssigning cluster with {len(hash_list)} sequences to split # {split_number} ({args.fasta})")
-
-        for hash_str in hash_list:
-            original_record = hash_lookup[hash_str]
-            outputs[split_number].append(original_record)
+    with metrics.stage("parse clusters", file=fasta) as stage:
+        cluster_rows = [
+            [row for hash_str in hash_list for row in fasta_index.find_all(hash_str)]
+            for hash_list in fetch_clusters(clusters)
+        ]
+        stage.records = len(cluster_rows)
+
+    # Assign whole clusters to groups
+    with metrics.stage("assign folds", file=fasta) as stage:
+        weights = cluster_weights(
+            cluster_rows, fasta_index.residues if weight == "residues" else None
+        )
+        outputs = defaultdict(list)
+        for split_number, rows in zip(
+            assign_folds(weights, number, strategy), cluster_rows
+        ):
+            metrics.detail(
+                f"\t\tAssigning cluster with {len(rows)} sequences to split "
+                f"# {split_number} ({fasta})"
+            )
+            outputs[split_number].extend(rows)
+        stage.records = len(cluster_rows)
 
     # Write the output files
     print("Writing output files...")
-    for key, records in outputs.items():
-        output_file = f"{key}_{args.fasta.stem}.fasta"
-        print(f"\tWriting {len(records)} records to {output_file}")
-        SeqIO.write(records, output_file, "fasta")
+    with metrics.stage("write outputs", file=fasta) as stage:
+        for key, records in outputs.items():
+            output_file = output_path(f"{key}_{fasta_stem(fasta)}.fasta", compress)
+            print(f"\tWriting {len(records)} records to {output_file}")
+            with xopen(output_file, "wb") as f:
+                fasta_index.write_records(records, f)
+            stage.add(len(records))
+
+    fasta_index.close()
 
     # Remove the temporary files after it's no longer needed
     os.remove(temp_file_path)
-    os.remove(cd_hit_output)
+    if cd_hit_output is not None:
+        os.remove(cd_hit_output)
+
+
+def main():
+    args = get_args()
+    with metrics.run("train_test_split_lowest_cluster", args):
+        split(args)
+
+
+def split(args):
+    options = dict(
+        number=args.Number,
+        cd_hit=args.cd_hit,
+        cache_dir=args.cache_dir,
+        no_cache=args.no_cache,
+        strategy=args.strategy,
+        weight=args.weight,
+        backend=args.backend,
+        compress=args.compress,
+        no_temp_dir=args.no_temp_dir,
+        timeout=args.timeout,
+        word_filter=args.word_filter,
+    )
+    resources = dict(threads=args.threads, memory=args.memory)
+    if args.fasta_dir is not None:
+        run_batch(
+            split_fasta, fasta_files(args.fasta_dir), args.jobs, **resources, **options
+        )
+    else:
+        split_fasta(args.fasta, **resources, **options)
 
 
 if __name__ == "__main__":
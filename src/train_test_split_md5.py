@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+from . import metrics
+from .cd_hit_runner import add_cd_hit_arguments
+from .cluster_cache import ClusterCache, add_cache_arguments, cached_clusters
+from .clustering import add_backend_arguments, backend_params, cache_params, cluster
+from .fasta_io import (
+    add_compression_argument,
+    incomplete_path,
+    output_path,
+    strip_compression,
+    xopen,
+)
+from .sequence_store import SequenceStore
+
+CD_HIT_PARAMS = {"c": 0.4, "n": 2, "d": 100, "sc": 1, "sf": 1}
+LINE_WIDTH = 80
+FIELD_SEPARATOR = re.compile(rb"[ \t]+")
+MD5_BYTES = hashlib.md5().digest_size
+
+
+def validate_path(path):
+    path = Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(f"File not found: {path}")
+    return path
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description=r"""
+        Split a fasta file into N groups with no more than 40% sequence homology.
+        Sequence headers are replaced with their MD5 hash before clustering and the
+        clusters are written to the output files round-robin. This is a drop-in
+        replacement for train_test_split.sh.
+        """,
+        formatter_class=argparse.HelpFormatter,
+    )
+    parser.add_argument(
+        "-f",
+        "--fasta",
+        type=validate_path,
+        required=True,
+        help="Path to the FASTA file to be split.",
+    )
+    parser.add_argument(
+        "-n", "--Number", type=int, default=11, help="Number of groups to split into."
+    )
+    parser.add_argument(
+        "--cd-hit",
+        type=str,
+        required=False,
+        default="cd-hit",
+        help="Path to the cd-hit program.",
+    )
+    add_backend_arguments(parser)
+    add_cache_arguments(parser)
+    add_cd_hit_arguments(parser)
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+def hash_headers(fasta, hashed_fasta):
+    # records by the md5 of their header, the first record wins on duplicates
+    hash_lookup = SequenceStore(id_bytes=MD5_BYTES)
+
+    print("Hashing input file headers")
+    with xopen(fasta, "rb") as f_in, open(hashed_fasta, "wb") as f_out:
+        seq_hash = None
+        header = None
+        seq_lines = []
+
+        for line in f_in:
+            line = line.rstrip(b"\n")
+            if line.startswith(b">"):
+                if seq_hash is not None:
+                    hash_lookup.add(header, b"".join(seq_lines), seq_hash)
+                header = line[1:]
+                seq_hash = hashlib.md5(header).hexdigest()
+                seq_lines = []
+                f_out.write(b">" + seq_hash.encode() + b"\n")
+            else:
+                if seq_hash is not None:
+                    seq_lines.append(line)
+                f_out.write(line + b"\n")
+
+        if seq_hash is not None:
+            hash_lookup.add(header, b"".join(seq_lines), seq_hash)
+
+    return hash_lookup
+
+
+def call_cd_hit(
+    fasta,
+    output_file,
+    cd_hit,
+    backend="cd-hit",
+    threads=0,
+    memory=0,
+    timeout=None,
+    params=CD_HIT_PARAMS,
+):
+    return cluster(
+        fasta, output_file, params, backend, cd_hit, threads, memory, timeout
+    )
+
+
+def format_record(header, seq):
+    # match the whitespace handling and 80 column wrapping of train_test_split.sh
+    header = b" ".join(x for x in FIELD_SEPARATOR.split(header) if x)
+    seq = seq.rstrip(b" \t")
+
+    lines = [b">" + header]
+    while len(seq) > LINE_WIDTH:
+        lines.append(seq[:LINE_WIDTH])
+        seq = seq[LINE_WIDTH:]
+    lines.append(seq)
+
+    return b"\n".join(lines) + b"\n"
+
+
+def split_path(counter, class_name, compress=None):
+    return output_path(f"{counter}_{class_name}.fasta", compress)
+
+
+def write_splits(clusters, hash_lookup, number, class_name, compress=None):
+    handles = {}
+    counter = 1
+
+    try:
+        for cluster_number, hashes in enumerate(clusters, 1):
+            temp_path = incomplete_path(split_path(counter, class_name, compress))
+            if counter not in handles:
+                handles[counter] = xopen(temp_path, "wb")
+            metrics.detail(
+                f"writing {len(hashes)} hashes from cluster {cluster_number} to "
+                f"{temp_path}"
+            )
+
+            for seq_hash in hashes:
+                row = hash_lookup.find(seq_hash)
+                handles[counter].write(
+                    format_record(hash_lookup.header(row), hash_lookup.residues(row))
+                )
+
+            counter = counter % number + 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    print("Marking fasta files as complete")
+    for key in handles:
+        final_path = split_path(key, class_name, compress)
+        os.replace(incomplete_path(final_path), final_path)
+
+
+def main():
+    args = get_args()
+    with metrics.run("train_test_split_md5", args):
+        split(args)
+
+
+def split(args):
+    class_name = strip_compression(args.fasta).name.rsplit(".", 1)[0]
+
+    print(f"Input file: {args.fasta.name}")
+    print(f"Input file class: {class_name}")
+
+    print("Checking for existing output files to prevent overwrites...")
+    for counter in range(1, args.Number + 1):
+        if split_path(counter, class_name, args.compress).exists():
+            raise FileExistsError(
+                f"{split_path(counter, class_name, args.compress)} already exists. "
+                "Please remove it before running this script."
+            )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        hashed_fasta = Path(temp_dir) / f"{class_name}.hashed.fasta"
+        cd_hit_output = Path(temp_dir) / f"{class_name}.cdhit.fasta"
+
+        # parsing and hashing happen while the temporary file is written
+        with metrics.stage("hash", file=args.fasta) as stage:
+            hash_lookup = hash_headers(args.fasta, hashed_fasta)
+            stage.records = len(hash_lookup)
+
+        cache = None if args.no_cache else ClusterCache(args.cache_dir)
+        params = backend_params(CD_HIT_PARAMS, args.backend, args.word_filter)
+        with metrics.stage("cluster", file=args.fasta):
+            clusters, _ = cached_clusters(
+                cache,
+                hashed_fasta,
+                cache_params(params, args.backend),
+                lambda: call_cd_hit(
+                    hashed_fasta,
+                    cd_hit_output,
+                    args.cd_hit,
+                    args.backend,
+                    args.threads,
+                    args.memory,
+                    args.timeout,
+                    params,
+                ),
+            )
+
+        # clusters are parsed as they are written out
+        print("Parsing cd-hit clusters")
+        with metrics.stage("write outputs", file=args.fasta) as stage:
+            write_splits(clusters, hash_lookup, args.Number, class_name, args.compress)
+            stage.records = len(hash_lookup)
+
+    print("Done!")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
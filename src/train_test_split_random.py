@@ -3,9 +3,17 @@
 import argparse
 import random
 import sys
+from array import array
+from contextlib import ExitStack
+from hashlib import blake2b
 from pathlib import Path
 
-from Bio import SeqIO
+import numpy as np
+
+from . import metrics
+from .fasta_index import iter_records, record_residues
+from .fasta_io import add_compression_argument, fasta_stem, output_path, xopen
+from .sequence_store import SequenceStore
 
 
 def validate_path(path):
@@ -15,7 +23,7 @@ def validate_path(path):
     return path
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description=r"""
         Split a fasta file into N random sub-files.
@@ -32,31 +40,111 @@ def get_args():
     parser.add_argument(
         "-n", "--number", type=int, default=11, help="Number of groups to split into."
     )
+    parser.add_argument(
+        "-s",
+        "--streaming",
+        choices=["hash", "permutation"],
+        default=None,
+        help="Write records as they are read instead of shuffling them in memory. "
+        "hash: group picked by a seeded hash of the sequence. permutation: count the "
+        "records first, then shuffle only the group numbers (two passes, even groups).",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=100, help="Random seed. Default: 100"
+    )
 
-    args = parser.parse_args()
+    add_compression_argument(parser)
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
     return args
 
 
+def hash_groups(fasta, number, seed):
+    key = seed.to_bytes(8, "little", signed=True)
+    for _, lines in iter_records(fasta):
+        residues = record_residues([line.rstrip(b"\n") for line in lines[1:]])
+        digest = blake2b(residues, key=key, digest_size=8).digest()
+        yield int.from_bytes(digest, "little") % number, lines
+
+
+def permutation_groups(fasta, number, seed):
+    record_count = sum(1 for _ in iter_records(fasta))
+    dtype = np.uint8 if number <= 256 else np.uint32
+    # only the group of every record is shuffled, one or four bytes per record
+    groups = np.resize(np.arange(number, dtype=dtype), record_count)
+    np.random.default_rng(seed).shuffle(groups)
+
+    for group, (_, lines) in zip(groups, iter_records(fasta)):
+        yield int(group), lines
+
+
+def split_paths(fasta, number, compress=None):
+    return [
+        output_path(f"{i}_{fasta_stem(fasta)}.fasta", compress)
+        for i in range(1, number + 1)
+    ]
+
+
+def streaming_split(fasta, number, mode, seed, compress=None):
+    groups = hash_groups if mode == "hash" else permutation_groups
+    counts = [0] * number
+    paths = split_paths(fasta, number, compress)
+
+    with ExitStack() as stack:
+        stage = stack.enter_context(metrics.stage("write outputs", file=fasta))
+        outputs = [stack.enter_context(xopen(path, "wb")) for path in paths]
+        for group, lines in groups(fasta, number, seed):
+            if not lines[-1].endswith(b"\n"):
+                lines[-1] += b"\n"
+            outputs[group].writelines(lines)
+            counts[group] += 1
+        stage.records = sum(counts)
+
+    for path, count in zip(paths, counts):
+        print(f"\tWrote {count} records to {path}")
+
+
 def main():
-    random.seed(100)
     args = get_args()
+    with metrics.run("train_test_split_random", args):
+        random_split(args)
+
 
-    with open(args.fasta, "r") as f:
-        records = list(SeqIO.parse(f, "fasta"))
-        # Shuffle the records to ensure randomness
+def random_split(args):
+    if args.streaming is not None:
+        return streaming_split(
+            args.fasta, args.number, args.streaming, args.seed, args.compress
+        )
 
-        random.shuffle(records)
+    random.seed(args.seed)
+    # written back wrapped at 60 residues like SeqIO did
+    records = SequenceStore()
+    with metrics.stage("parse", file=args.fasta) as stage:
+        for _, lines in iter_records(args.fasta):
+            records.add(
+                lines[0][1:].rstrip(),
+                record_residues([line.rstrip() for line in lines[1:]]),
+            )
+        stage.records = len(records)
+    # Shuffle the records to ensure randomness, shuffling their rows draws the same
+    # permutation as shuffling the records themselves
+    rows = array("q", range(len(records)))
+    random.shuffle(rows)
 
-        # Split the records into N sub-files
-        sub_files = [[] for _ in range(args.number)]
-        for i, record in enumerate(records):
-            sub_files[i % args.number].append(record)
+    # Split the records into N sub-files
+    sub_files = [rows[i :: args.number] for i in range(args.number)]
 
-        # Write the sub-files
-        for i, sub_file in enumerate(sub_files, 1):
-            output_file = f"{i}_{args.fasta.stem}.fasta"
+    # Write the sub-files
+    with metrics.stage("write outputs", file=args.fasta) as stage:
+        for output_file, sub_file in zip(
+            split_paths(args.fasta, args.number, args.compress), sub_files
+        ):
             print(f"\tWriting {len(sub_file)} records to {output_file}")
-            SeqIO.write(sub_file, output_file, "fasta")
+            with xopen(output_file, "wb") as f:
+                for row in sub_file:
+                    records.write_record(f, row)
+        stage.records = len(records)
 
 
 if __name__ == "__main__":